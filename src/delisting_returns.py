@@ -0,0 +1,102 @@
+"""
+Adjust CRSP monthly returns for delisting.
+
+Follows the instructions for handling delisting returns in Chapter 7 of
+Bali, Engle, Murray --
+Empirical asset pricing-the cross section of stock returns (2016):
+
+ - If the delisting return is missing and the delisting code is 500, 520,
+   551-574, 580 or 584 (delisted for poor performance), the delisting
+   return is -30%.
+ - If the delisting return is missing and the delisting code is any other
+   code of 200 or above (i.e., the stock was delisted), the delisting return
+   is -100%.
+ - Otherwise the delisting return is left as is.
+ - A missing return is then replaced by the delisting return.
+
+The same rules apply to returns without dividends (`retx`, `dlretx`).
+"""
+
+import numpy as np
+import pandas as pd
+import polars as pl
+
+PERFORMANCE_DELISTING_CODES = [500, 520, 580, 584] + list(range(551, 575))
+
+
+def _delisting_return_lookup():
+    lookup = np.full(1000, np.nan)
+    lookup[200:] = -1.0
+    lookup[PERFORMANCE_DELISTING_CODES] = -0.3
+    return lookup
+
+
+# Delisting return to use when it is missing, indexed by delisting code
+DELISTING_RETURN_LOOKUP = _delisting_return_lookup()
+_LOOKUP_CODES = np.flatnonzero(~np.isnan(DELISTING_RETURN_LOOKUP))
+
+RETURN_COLUMNS = [("ret", "dlret"), ("retx", "dlretx")]
+
+
+def delisting_return_fill(dlstcd):
+    """Return the delisting return implied by each delisting code, for use
+    where the delisting return is missing. Missing or active (below 200)
+    codes give NaN.
+
+    Examples
+    --------
+
+    ```
+    >>> delisting_return_fill([100, 241, 560, np.nan])
+    array([ nan, -1. , -0.3,  nan])
+
+    ```
+    """
+    codes = np.asarray(dlstcd, dtype=float)
+    valid = (codes >= 0) & (codes < len(DELISTING_RETURN_LOOKUP))
+    fill = np.full(codes.shape, np.nan)
+    fill[valid] = DELISTING_RETURN_LOOKUP[codes[valid].astype(int)]
+    return fill
+
+
+def apply_delisting_returns(df, library="pandas"):
+    """
+    Fill in missing delisting returns (`dlret`, `dlretx`) from the
+    delisting code `dlstcd`, and then missing returns (`ret`, `retx`) from
+    the delisting returns. See the module docstring for the rules.
+
+    The fill values are looked up once from `DELISTING_RETURN_LOOKUP` and
+    used for both return columns. With library="pandas", `df` is modified in
+    place and returned. With library="polars", `df` can be a DataFrame or a
+    LazyFrame, and NaN returns are treated as missing (and returned as null).
+    """
+    if library == "pandas":
+        fill = delisting_return_fill(df["dlstcd"])
+        for ret_col, dlret_col in RETURN_COLUMNS:
+            dlret = df[dlret_col].to_numpy(dtype=float, na_value=np.nan)
+            df[dlret_col] = np.where(np.isnan(dlret), fill, dlret)
+            df[ret_col] = df[ret_col].fillna(df[dlret_col])
+        return df
+
+    elif library == "polars":
+        fill = (
+            pl.col("dlstcd")
+            .cast(pl.Float64)
+            .fill_nan(None)
+            .cast(pl.Int64)
+            .replace_strict(
+                _LOOKUP_CODES.tolist(),
+                DELISTING_RETURN_LOOKUP[_LOOKUP_CODES].tolist(),
+                default=None,
+                return_dtype=pl.Float64,
+            )
+        )
+        exprs = []
+        for ret_col, dlret_col in RETURN_COLUMNS:
+            dlret = pl.col(dlret_col).cast(pl.Float64).fill_nan(None).fill_null(fill)
+            ret = pl.col(ret_col).cast(pl.Float64).fill_nan(None).fill_null(dlret)
+            exprs += [dlret.alias(dlret_col), ret.alias(ret_col)]
+        return df.with_columns(exprs)
+
+    else:
+        raise ValueError("Unknown library")
@@ -10,6 +10,7 @@ import requests
 from io import BytesIO
 from pathlib import Path
 import settings
+from misc_tools import load_parquet
 
 DATA_DIR = settings.DATA_DIR
 START_DATE = settings.START_DATE
@@ -30,9 +31,18 @@ def pull_fed_yield_curve():
     cols = ['SVENY' + str(i).zfill(2) for i in range(1, 31)]
     return df[cols]
 
-def load_fed_yield_curve(data_dir=DATA_DIR):
+def load_fed_yield_curve(
+    data_dir=DATA_DIR, columns=None, start_date=None, end_date=None, library="pandas"
+):
     path = data_dir  / "fed_yield_curve.parquet"
-    _df = pd.read_parquet(path)
+    _df = load_parquet(
+        path,
+        columns=columns,
+        date_col="Date",
+        start_date=start_date,
+        end_date=end_date,
+        library=library,
+    )
     return _df
     
 if __name__ == "__main__":
@@ -5,11 +5,25 @@
 import numpy as np
 import pandas as pd
 import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import requests
 from matplotlib import pyplot as plt
 import matplotlib.dates as mdates
 
-from dateutil.relativedelta import relativedelta
-import datetime
+import base64
+import io
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 ########################################################################################
@@ -17,7 +31,37 @@ import datetime
 ########################################################################################
 
 
-def df_to_literal(df, missing_value="None"):
+def _literal_items(values, missing_value, chunksize):
+    """Yield the literal representation of `values`, chunk by chunk.
+
+    Missing values (NaN, NaT, None, pd.NA) are written as `missing_value`,
+    so that no string replacement of the output is needed. Timestamps and
+    Timedeltas are written with a `pd.` prefix.
+    """
+    for start in range(0, len(values), chunksize):
+        chunk = values.iloc[start : start + chunksize]
+        missing = chunk.isna().to_numpy()
+        items = []
+        for value, is_missing in zip(chunk.tolist(), missing):
+            if is_missing:
+                items.append(missing_value)
+            elif isinstance(value, (pd.Timestamp, pd.Timedelta)):
+                items.append(f"pd.{value!r}")
+            else:
+                items.append(repr(value))
+        yield ", ".join(items)
+
+
+def _write_literal_list(file, values, missing_value, chunksize):
+    file.write("[")
+    for i, items in enumerate(_literal_items(values, missing_value, chunksize)):
+        if i > 0:
+            file.write(", ")
+        file.write(items)
+    file.write("]")
+
+
+def df_to_literal(df, missing_value="None", file=None, chunksize=10_000, compact=False):
     """Convert a pandas dataframe to a literal string representing the code to recreate it.
 
     Converts a pandas DataFrame into a string representation that can be used to
@@ -28,6 +72,17 @@ def df_to_literal(df, missing_value="None"):
     ----------
     df : pandas.DataFrame
         The DataFrame to convert to a literal string representation.
+    missing_value : str, Default "None"
+        The literal used for missing values (NaN, NaT, None, pd.NA).
+    file : str, Path or file-like, optional
+        If given, the code is written to this file chunk by chunk, without
+        building the whole string in memory, and None is returned.
+    chunksize : int, Default 10_000
+        Number of values converted at a time.
+    compact : bool, Default False
+        If True, the frame is stored as a base64-encoded parquet blob, which is
+        much smaller and faster to load for large frames. The generated code
+        requires `base64` and `io` to be imported.
 
     Returns
     -------
@@ -45,7 +100,7 @@ def df_to_literal(df, missing_value="None"):
     df = pd.DataFrame(
     {
         'Name': ['Alice', 'Bob', None],
-        'Age': [25, None, 35],
+        'Age': [25.0, None, 35.0],
         'City': ['New York', 'Los Angeles', 'Chicago']
     }, index=['a', 'b', 'c']
     )
@@ -57,33 +112,157 @@ def df_to_literal(df, missing_value="None"):
     - Index values (if not default RangeIndex)
     - None values (converted from NaN)
     """
-    cols = df.to_dict("list")
-    lines = []
-    lines.append("df = pd.DataFrame(")
-    lines.append("{")
-    for idx, (col, values) in enumerate(cols.items()):
-        line = f"    '{col}': {values}"
-        if idx < len(cols) - 1:
-            line += ","
-        lines.append(line)
-    lines.append("}")
+    if file is None:
+        buffer = io.StringIO()
+        df_to_literal(
+            df,
+            missing_value=missing_value,
+            file=buffer,
+            chunksize=chunksize,
+            compact=compact,
+        )
+        return buffer.getvalue()
+    if isinstance(file, (str, Path)):
+        with open(file, "w") as f:
+            return df_to_literal(
+                df,
+                missing_value=missing_value,
+                file=f,
+                chunksize=chunksize,
+                compact=compact,
+            )
+
+    if compact:
+        blob = base64.b64encode(df.to_parquet()).decode("ascii")
+        file.write("df = pd.read_parquet(io.BytesIO(base64.b64decode(\n")
+        for start in range(0, len(blob), 76):
+            file.write(f'    "{blob[start : start + 76]}"\n')
+        file.write(")))")
+        return None
+
+    file.write("df = pd.DataFrame(\n{\n")
+    for idx, col in enumerate(df.columns):
+        file.write(f"    '{col}': ")
+        _write_literal_list(file, df.iloc[:, idx], missing_value, chunksize)
+        if idx < len(df.columns) - 1:
+            file.write(",")
+        file.write("\n")
+    file.write("}")
 
     # Add index if it's not default RangeIndex
     if (
         not isinstance(df.index, pd.RangeIndex)
         or not (df.index == pd.RangeIndex(len(df))).all()
     ):
-        index_values = list(df.index)
-        lines[-1] += f", index={index_values}"
+        file.write(", index=")
+        index_values = pd.Series(df.index.tolist(), dtype=object)
+        _write_literal_list(file, index_values, missing_value, chunksize)
+
+    file.write("\n)")
+    return None
+
+
+def _key_dtypes(df, on):
+    if isinstance(df, (str, Path)):
+        schema = pq.read_schema(df)
+        return {col: np.dtype(schema.field(col).type.to_pandas_dtype()) for col in on}
+    return df[on].dtypes.to_dict()
+
+
+def _is_number_dtype(dtype):
+    return pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(
+        dtype
+    )
+
 
-    lines.append(")")
-    output = "\n".join(lines)
-    # Replace 'nan' with None in the output string
-    output = output.replace("nan", missing_value)
-    return output
+def _common_key_dtypes(df_left, df_right, on):
+    """Dtypes to cast the key columns of both sides to before hashing.
+
+    Numbers are cast to their common type, with integers made nullable, as
+    chunks of integer parquet columns with nulls are read as floats.
+    Datetimes are normalized to nanosecond resolution. Other mismatches
+    raise, as equal keys would otherwise silently hash differently.
+    """
+    is_datetime = pd.api.types.is_datetime64_any_dtype
+    left_dtypes = _key_dtypes(df_left, on)
+    right_dtypes = _key_dtypes(df_right, on)
+    dtypes = {}
+    for col in on:
+        left, right = left_dtypes[col], right_dtypes[col]
+        if _is_number_dtype(left) and _is_number_dtype(right):
+            common = np.result_type(
+                getattr(left, "numpy_dtype", left), getattr(right, "numpy_dtype", right)
+            )
+            if common.kind in "iu":
+                common = pd.array(np.array([], dtype=common)).dtype
+            dtypes[col] = common
+        elif is_datetime(left) and is_datetime(right):
+            dtypes[col] = "datetime64[ns]"
+        elif left != right:
+            raise ValueError(
+                f"Key column {col!r} has incompatible dtypes {left} and {right}"
+            )
+    return dtypes
+
+
+def _hash_key_columns(df, on, dtypes):
+    """Hash the key tuples of `on` to uint64, after casting to `dtypes`."""
+    keys = df[on].astype(dtypes)
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+
+def _unique_key_hashes(df, on, dtypes, chunksize):
+    """Sorted unique uint64 hashes of the key tuples of a DataFrame or parquet file.
+
+    The keys are hashed chunk by chunk, so that only the compact hashes of the
+    unique keys are kept in memory.
+    """
+    if isinstance(df, (str, Path)):
+        parquet_file = pq.ParquetFile(df)
+        chunks = (
+            batch.to_pandas()
+            for batch in parquet_file.iter_batches(batch_size=chunksize, columns=on)
+        )
+    else:
+        chunks = (df.iloc[i : i + chunksize] for i in range(0, len(df), chunksize))
+    hashes = [np.unique(_hash_key_columns(chunk, on, dtypes)) for chunk in chunks]
+    if not hashes:
+        return np.array([], dtype=np.uint64)
+    return np.unique(np.concatenate(hashes))
+
+
+def _lazy_unique_keys(df, on):
+    if isinstance(df, (str, Path)):
+        df = pl.scan_parquet(df)
+    elif isinstance(df, pd.DataFrame):
+        df = pl.from_pandas(df[on])
+    return df.lazy().select(on).unique()
+
+
+def _cast_lazy_keys_to_common(left_keys, right_keys, on):
+    """Cast the key columns of both LazyFrames to their polars supertypes."""
+    left_schema = left_keys.collect_schema()
+    right_schema = right_keys.collect_schema()
+    for col in on:
+        left, right = left_schema[col], right_schema[col]
+        compatible = (left.is_numeric() and right.is_numeric()) or (
+            left.is_temporal() and right.is_temporal()
+        )
+        if left != right and not compatible:
+            raise ValueError(
+                f"Key column {col!r} has incompatible dtypes {left} and {right}"
+            )
+    common = pl.concat(
+        [
+            pl.DataFrame(schema={col: left_schema[col] for col in on}),
+            pl.DataFrame(schema={col: right_schema[col] for col in on}),
+        ],
+        how="vertical_relaxed",
+    ).schema
+    return left_keys.cast(dict(common)), right_keys.cast(dict(common))
 
 
-def merge_stats(df_left, df_right, on=[]):
+def merge_stats(df_left, df_right, on=[], method="index", chunksize=1_000_000):
     """Provide statistics to assess the completeness of the merge.
 
     To assess the completeness of the merge, this function counts the number of unique
@@ -102,11 +281,54 @@ def merge_stats(df_left, df_right, on=[]):
     'intersection/left': percentage of matched based on total in left index
     'intersection/right': percentage of matched based on total in right index
 
+    The counts can be computed with one of the following methods:
+
+    - "index": build the unique indices of the keys and their union and
+      intersection with pandas.
+    - "hash": hash the key tuples, in chunks of `chunksize` rows, into compact
+      uint64 arrays and count with sorted-array set operations. Uses a small
+      fraction of the memory of "index". Distinct keys hashing to the same
+      value would be counted as one, which is vanishingly unlikely with
+      64-bit hashes. Numeric keys are compared by value, e.g., a float
+      `lpermno` matches an int `permno`. `df_left` and `df_right` may be pandas DataFrames or paths
+      to parquet files.
+    - "polars": count unique keys and their inner join with polars' streaming
+      engine. `df_left` and `df_right` may be pandas or polars DataFrames,
+      polars LazyFrames or paths to parquet files.
+
     """
-    left_index = df_left.set_index(on).index.unique()
-    right_index = df_right.set_index(on).index.unique()
-    union = left_index.union(right_index)
-    intersection = left_index.intersection(right_index)
+    on = [on] if isinstance(on, str) else list(on)
+    if method == "index":
+        left_index = df_left.set_index(on).index.unique()
+        right_index = df_right.set_index(on).index.unique()
+        n_left = len(left_index)
+        n_right = len(right_index)
+        n_intersection = len(left_index.intersection(right_index))
+    elif method == "hash":
+        dtypes = _common_key_dtypes(df_left, df_right, on)
+        left_hashes = _unique_key_hashes(df_left, on, dtypes, chunksize)
+        right_hashes = _unique_key_hashes(df_right, on, dtypes, chunksize)
+        n_left = len(left_hashes)
+        n_right = len(right_hashes)
+        n_intersection = len(
+            np.intersect1d(left_hashes, right_hashes, assume_unique=True)
+        )
+    elif method == "polars":
+        left_keys, right_keys = _cast_lazy_keys_to_common(
+            _lazy_unique_keys(df_left, on), _lazy_unique_keys(df_right, on), on
+        )
+        n_left = left_keys.select(pl.len()).collect(streaming=True).item()
+        n_right = right_keys.select(pl.len()).collect(streaming=True).item()
+        n_intersection = (
+            left_keys.join(right_keys, on=on, how="inner", join_nulls=True)
+            .select(pl.len())
+            .collect(streaming=True)
+            .item()
+        )
+    else:
+        raise ValueError("Unknown method")
+    n_union = n_left + n_right - n_intersection
+
     stats = [
         "union",
         "intersection",
@@ -120,23 +342,43 @@ def merge_stats(df_left, df_right, on=[]):
         "intersection/right",
     ]
     df_stats = pd.Series(index=stats, dtype=int)
-    df_stats["union"] = len(union)
-    df_stats["intersection"] = len(intersection)
-    df_stats["union-intersection"] = len(union) - len(intersection)
-    df_stats["intersection/union"] = len(intersection) / len(union)
-    df_stats["left"] = len(left_index)
-    df_stats["right"] = len(right_index)
-    df_stats["left-intersection"] = len(left_index) - len(intersection)
-    df_stats["right-intersection"] = len(right_index) - len(intersection)
-    df_stats["intersection/left"] = len(intersection) / len(left_index)
-    df_stats["intersection/right"] = len(intersection) / len(right_index)
+    df_stats["union"] = n_union
+    df_stats["intersection"] = n_intersection
+    df_stats["union-intersection"] = n_union - n_intersection
+    df_stats["intersection/union"] = n_intersection / n_union
+    df_stats["left"] = n_left
+    df_stats["right"] = n_right
+    df_stats["left-intersection"] = n_left - n_intersection
+    df_stats["right-intersection"] = n_right - n_intersection
+    df_stats["intersection/left"] = n_intersection / n_left
+    df_stats["intersection/right"] = n_intersection / n_right
     return df_stats
 
 
+def _rows_equal(left, right):
+    """Elementwise equality of the rows of two frames, with NaN equal to NaN."""
+    equal = np.ones(len(left), dtype=bool)
+    for col in left.columns:
+        a = left[col].reset_index(drop=True)
+        b = right[col].reset_index(drop=True)
+        equal &= ((a == b).fillna(False) | (a.isna() & b.isna())).to_numpy(bool)
+    return equal
+
+
 def dataframe_set_difference(dff, df, library="pandas", show="rows_and_numbers"):
     """
     Gives the rows that appear in dff but not in df
 
+    Returns the positional row numbers of these rows in dff and, with
+    show="rows_and_numbers", also the rows themselves.
+
+    With library="pandas", every row is hashed to a uint64 and the hashes of
+    dff are looked up among the hashes of df, which takes near-linear time.
+    Rows whose hash is found are compared to the matching row of df, so that
+    a hash collision cannot hide a differing row. Missing values compare
+    equal, and numeric columns of different dtypes are compared by value in
+    their common dtype. With library="polars", an anti-join on all columns is used.
+
     Example
     -------
     ```
@@ -144,57 +386,75 @@ def dataframe_set_difference(dff, df, library="pandas", show="rows_and_numbers")
     ```
     """
     if library == "pandas":
-        # Reset index to ensure the row numbers are captured as a column
-        # This is important for tracking the original row numbers after operations
-        dff_reset = dff.reset_index().rename(columns={"index": "original_row_number"})
-        df_reset = df.reset_index(drop=True)
-
-        # Perform an outer merge with an indicator to identify rows present only in dff
-        merged = dff_reset.merge(
-            df_reset, how="left", indicator=True, on=dff.columns.tolist()
-        )
-
-        # Filter to rows only in dff (left_only)
-        only_in_dff = merged[merged["_merge"] == "left_only"]
+        columns = list(dff.columns)
+        df = df[columns]
+        # Compare columns of different dtypes by value, in their common dtype
+        mismatched = [col for col in columns if df[col].dtype != dff[col].dtype]
+        common_dtypes = _common_key_dtypes(dff, df, mismatched)
+        rows_dff = dff
+        if common_dtypes:
+            dff = dff.astype(common_dtypes)
+            df = df.astype(common_dtypes)
+
+        dff_hashes = pd.util.hash_pandas_object(dff, index=False).to_numpy()
+        # Unique hashes of df, indexed by the position of their first row
+        df_hashes = pd.util.hash_pandas_object(df, index=False)
+        df_hashes = df_hashes.reset_index(drop=True).drop_duplicates()
+        found_at = pd.Index(df_hashes.to_numpy()).get_indexer(dff_hashes)
+        in_df = found_at >= 0
+
+        # Verify that rows with matching hashes really are equal
+        candidates = np.flatnonzero(in_df)
+        df_positions = df_hashes.index.to_numpy()[found_at[candidates]]
+        verified = _rows_equal(dff.iloc[candidates], df.iloc[df_positions])
+        collisions = candidates[~verified]
+        if len(collisions) > 0:
+            # Compare the rare colliding rows to every row of df with that hash
+            colliding = dff.iloc[collisions].reset_index(drop=True)
+            merged = colliding.merge(
+                df.drop_duplicates(), how="left", indicator=True, on=columns
+            )
+            in_df[collisions] = (merged["_merge"] == "both").to_numpy()
 
-        # Extract the original row numbers of these rows
-        row_numbers = only_in_dff["original_row_number"].tolist()
+        row_numbers = np.flatnonzero(~in_df).tolist()
         ret = row_numbers
+        if show == "rows_and_numbers":
+            rows = rows_dff.iloc[row_numbers]
+            ret = row_numbers, rows
 
     elif library == "polars":
         # Assuming dff and df have the same schema (column names and types)
         assert dff.columns == df.columns
 
-        # First, add a temporary column to each DataFrame with row numbers
-        dff_with_index = dff.with_columns(pl.arange(0, dff.height).alias("row_number"))
-        df_with_index = df.with_columns(
-            pl.arange(0, df.height).alias("dummy_row_number")
-        )
-
-        # Perform an anti join to find rows in dff not present in df
-        # Note: This requires the DataFrames to have columns to join on that define row uniqueness
-
-        diff = dff_with_index.join(
-            df_with_index, on=list(dff.columns), how="anti", join_nulls=True
+        # Perform an anti join to find rows in dff not present in df.
+        # Only dff needs row numbers, to report which rows differ.
+        diff = dff.with_row_index("row_number").join(
+            df, on=list(dff.columns), how="anti", join_nulls=True
         )
 
         # Extract the row numbers of the differing rows
-        row_numbers = diff.select("row_number").to_series(0).to_list()
+        row_numbers = diff["row_number"].to_list()
         ret = row_numbers
+        if show == "rows_and_numbers":
+            rows = diff.drop("row_number")
+            ret = row_numbers, rows
 
     else:
         raise ValueError("Unknown library")
-    if show == "rows_and_numbers":
-        rows = dff[row_numbers]
-        ret = row_numbers, rows
 
     return ret
 
 
-def freq_counts(df, col=None, with_count=True, with_cum_freq=True):
+def freq_counts(df, col=None, with_count=True, with_cum_freq=True, weight_col=None):
     """Like value_counts, but normalizes to give frequency
     Polars function
-    df is a polars dataframe
+    df is a polars DataFrame or LazyFrame
+
+    `col` may be a list of columns, in which case the combinations of their
+    values are counted. With `weight_col`, the weights are summed instead of
+    counting rows, giving weighted frequencies. The query is run with polars'
+    streaming engine, so a LazyFrame scanned from large parquet files can be
+    counted with bounded memory.
 
     Example
     -------
@@ -203,15 +463,31 @@ def freq_counts(df, col=None, with_count=True, with_cum_freq=True):
         (pl.col("fdate") > pl.datetime(2020,1,1)) &
         (pl.col("bus_dt") == pl.col("fdate"))
     ).pipe(freq_counts, col="bus_tenor_bin")
+
+    pl.scan_parquet("CRSP_stock_ciz.parquet").pipe(
+        freq_counts, col=["primaryexch", "sharetype"], weight_col="shrout"
+    )
     ```
     """
-    s = df[col]
+    cols = [col] if isinstance(col, str) else list(col)
+    if weight_col is None:
+        count = pl.len()
+    else:
+        count = pl.col(weight_col).sum()
     ret = (
-        s.value_counts(sort=True)
+        df.lazy()
+        .group_by(cols)
+        .agg(count.alias("count"))
+        .sort(
+            ["count", *cols],
+            descending=[True] + [False] * len(cols),
+            nulls_last=True,
+        )
         .with_columns(
-            freq=pl.col("count") / s.shape[0] * 100,
+            freq=pl.col("count") / pl.col("count").sum() * 100,
         )
         .with_columns(cum_freq=pl.col("freq").cum_sum())
+        .collect(streaming=True)
     )
     if not with_count:
         ret = ret.drop("count")
@@ -232,9 +508,71 @@ def move_column_inplace(df, col, pos=0):
 
 
 def move_columns_to_front(df, cols=[]):
-    """Move a list of columns `cols` so that they appear first"""
-    for col in cols[::-1]:
-        move_column_inplace(df, col, pos=0)
+    """Move a list of columns `cols` so that they appear first
+
+    This modifies `df` in place. The order is computed as in
+    `reorder_columns` and applied in a single stable sort of the columns.
+    """
+    columns = list(df.columns)
+    missing = set(cols).difference(columns)
+    if missing:
+        raise KeyError(sorted(missing))
+    position = {col: i for i, col in enumerate(_front_columns(columns, cols))}
+    df.sort_index(
+        axis=1, key=lambda index: index.map(position), kind="stable", inplace=True
+    )
+
+
+def _front_columns(columns, cols, regex=None):
+    """Return `columns` with `cols`, then the columns matching `regex`, first."""
+    front = list(dict.fromkeys(cols))
+    front_set = set(front)
+    if regex is not None:
+        pattern = re.compile(regex)
+        for col in columns:
+            if col not in front_set and pattern.search(col):
+                front.append(col)
+                front_set.add(col)
+    return front + [col for col in columns if col not in front_set]
+
+
+def reorder_columns(df, cols=[], regex=None, library="pandas"):
+    """Return `df` with the columns `cols`, then the columns matching `regex`,
+    moved to the front.
+
+    The final column order is computed once and applied in a single
+    indexing step (pandas) or `select` (polars), rather than moving one column at
+    a time. The columns matching `regex` (searched with `re.search`) and the
+    remaining columns keep their current order. With library="polars", `df`
+    may be a DataFrame or LazyFrame and `cols` may also contain polars
+    selectors or expressions, such as `cs.starts_with("dlret")`. Names in
+    `cols` that are not columns of `df` raise an error.
+
+    Examples
+    --------
+
+    ```
+    >>> df = pd.DataFrame(columns=['at', 'sale', 'gvkey', 'datadate', 'xint', 'xsga'])
+    >>> reorder_columns(df, cols=['gvkey', 'datadate'], regex='^x').columns.tolist()
+    ['gvkey', 'datadate', 'xint', 'xsga', 'at', 'sale']
+
+    ```
+    """
+    if library == "pandas":
+        columns = list(df.columns)
+    elif library == "polars":
+        columns = df.collect_schema().names()
+        if not all(isinstance(col, str) for col in cols):
+            cols = df.lazy().select(cols).collect_schema().names()
+    else:
+        raise ValueError("Unknown library")
+
+    order = _front_columns(columns, cols, regex)
+
+    if library == "pandas":
+        # Indexing, unlike reindex, raises a KeyError for unknown columns
+        return df[order]
+    return df.select(order)
 
 
 def weighted_average(data_col=None, weight_col=None, data=None):
@@ -270,6 +608,7 @@ def groupby_weighted_average(
     data=None,
     transform=False,
     new_column_name="",
+    library="pandas",
 ):
     """
     Faster method for calculating grouped weighted average.
@@ -277,6 +616,19 @@ def groupby_weighted_average(
     From:
     https://stackoverflow.com/a/44683506
 
+    The weighted sums are computed from temporary arrays, so `data` is never
+    modified. `data_col` may be a list of columns sharing the same
+    `weight_col`, in which case a frame with one column per data column is
+    returned. Missing values (and their weights) are left out of the average.
+
+    With `transform=True`, the group averages are broadcast back onto the rows
+    of `data` (aligned on its index) and, for a single `data_col`, the result
+    is named `new_column_name`.
+
+    With library="polars", `data` is a polars DataFrame or LazyFrame and a
+    frame of the same type is returned: the `by_col` columns and the averages,
+    sorted by `by_col`, or with `transform=True`, one row per row of `data`.
+
     Examples
     --------
 
@@ -295,30 +647,101 @@ def groupby_weighted_average(
     ```
 
     """
-    data["_data_times_weight"] = data[data_col] * data[weight_col]
-    data["_weight_where_notnull"] = data[weight_col] * pd.notnull(data[data_col])
-    g = data.groupby(by_col)
-    result = g["_data_times_weight"].sum() / g["_weight_where_notnull"].sum()
-    del data["_data_times_weight"], data["_weight_where_notnull"]
+    cols = [data_col] if isinstance(data_col, str) else list(data_col)
+
+    if library == "pandas":
+        keys = _groupby_keys(data, by_col)
+        values = data[cols]
+        weights = data[weight_col]
+        data_times_weight = values.mul(weights, axis=0)
+        weight_where_notnull = values.notna().mul(weights, axis=0)
+        if transform:
+            result = data_times_weight.groupby(keys).transform(
+                "sum"
+            ) / weight_where_notnull.groupby(keys).transform("sum")
+        else:
+            result = (
+                data_times_weight.groupby(keys).sum()
+                / weight_where_notnull.groupby(keys).sum()
+            )
+        if isinstance(data_col, str):
+            result = result[data_col]
+            result.name = new_column_name if transform else None
+
+    elif library == "polars":
+        by_cols = list(by_col) if isinstance(by_col, (list, tuple)) else [by_col]
+        weights = pl.col(weight_col)
+
+        def data_times_weight(col):
+            return (pl.col(col) * weights).sum()
+
+        def weight_where_notnull(col):
+            return pl.when(pl.col(col).is_not_null()).then(weights).sum()
+
+        if transform:
+            names = (
+                [new_column_name]
+                if isinstance(data_col, str) and new_column_name
+                else cols
+            )
+            result = data.lazy().select(
+                (
+                    data_times_weight(col).over(by_cols)
+                    / weight_where_notnull(col).over(by_cols)
+                ).alias(name)
+                for col, name in zip(cols, names)
+            )
+        else:
+            result = (
+                data.lazy()
+                .group_by(by_cols)
+                .agg(
+                    (data_times_weight(col) / weight_where_notnull(col)).alias(col)
+                    for col in cols
+                )
+                .sort(by_cols)
+            )
+        if isinstance(data, pl.DataFrame):
+            result = result.collect()
 
-    if transform:
-        result.name = f"__{data_col}"
-        result = data.merge(result.reset_index(), how="left", on=by_col)[
-            f"__{data_col}"
-        ]
-        result.name = new_column_name
+    else:
+        raise ValueError("Unknown library")
 
     return result
 
 
+def _groupby_keys(data, by_col):
+    """Return grouping keys for `data` as Series, so that temporary frames
+    built from `data`'s columns can be grouped without adding columns to it."""
+    if isinstance(by_col, (list, tuple)):
+        return [data[c] for c in by_col]
+    return data[by_col]
+
+
 def groupby_weighted_std(
-    data_col=None, weight_col=None, by_col=None, data=None, ddof=1
+    data_col=None, weight_col=None, by_col=None, data=None, ddof=1, library="pandas"
 ):
     """
     Method for calculating grouped weighted standard devation.
 
-    From:
-    https://stackoverflow.com/a/72915123
+    The weighted mean and variance of every group are computed at once from
+    grouped sums (sum of weights, sum of weight * value, sum of
+    weight * value^2 and counts) rather than by calling a Python function
+    per group. Values are shifted by the first value in each group before
+    summing, which avoids the loss of precision of the naive sum-of-squares
+    formula. As in https://stackoverflow.com/a/72915123, the variance is
+
+    $\\frac{\\sum_i w_i (x_i - \\bar{x}_w)^2}{\\frac{n - ddof}{n} \\sum_i w_i}$
+
+    Groups containing a missing value or weight give NaN.
+
+    Parameters
+    ----------
+    library : str, Default "pandas"
+        "pandas" expects a pandas DataFrame and returns a Series indexed by
+        `by_col`. "polars" expects a polars DataFrame or LazyFrame and returns
+        a polars DataFrame with the `by_col` columns and the standard deviation
+        in a column named `data_col`, sorted by `by_col`.
 
     Examples
     --------
@@ -352,19 +775,52 @@ def groupby_weighted_std(
     ```
 
     """
+    if library == "pandas":
+        keys = _groupby_keys(data, by_col)
+        vals = data[data_col]
+        weights = data[weight_col]
+        vals = vals - vals.groupby(keys).transform("first")
+        parts = pd.DataFrame(
+            {
+                "w": weights,
+                "wx": weights * vals,
+                "wxx": weights * vals * vals,
+                "is_missing": vals.isna() | weights.isna(),
+            },
+            index=data.index,
+        )
+        sums = parts.groupby(keys).agg(
+            w=("w", "sum"),
+            wx=("wx", "sum"),
+            wxx=("wxx", "sum"),
+            n=("w", "size"),
+            is_missing=("is_missing", "any"),
+        )
+        numer = (sums["wxx"] - sums["wx"] ** 2 / sums["w"]).clip(lower=0)
+        denom = ((sums["n"] - ddof) / sums["n"]) * sums["w"]
+        result = np.sqrt(numer / denom).mask(sums["is_missing"])
+        result.name = None
 
-    def weighted_sd(input_df):
-        weights = input_df[weight_col]
-        vals = input_df[data_col]
-
-        weighted_avg = np.average(vals, weights=weights)
-
-        numer = np.sum(weights * (vals - weighted_avg) ** 2)
-        denom = ((vals.count() - ddof) / vals.count()) * np.sum(weights)
+    elif library == "polars":
+        by_cols = list(by_col) if isinstance(by_col, (list, tuple)) else [by_col]
+        x = pl.col(data_col)
+        w = pl.col(weight_col)
+        weighted_avg = (w * x).sum() / w.sum()
+        numer = (w * (x - weighted_avg) ** 2).sum()
+        n = pl.len()
+        denom = ((n - ddof) / n) * w.sum()
+        std = (
+            pl.when(x.is_null().any() | w.is_null().any())
+            .then(None)
+            .otherwise((numer / denom).sqrt())
+            .alias(data_col)
+        )
+        result = data.lazy().group_by(by_cols).agg(std).sort(by_cols).collect()
 
-        return np.sqrt(numer / denom)
+    else:
+        raise ValueError("Unknown library")
 
-    return data.groupby(by_col).apply(weighted_sd)
+    return result
 
 
 def weighted_quantile(
@@ -396,10 +852,12 @@ def weighted_quantile(
 
     FROM: https://stackoverflow.com/a/29677616
 
-    NOTE: that a groupby weighted quantile can look like this:
+    NOTE: for a groupby weighted quantile, use `groupby_weighted_quantile`,
+    which computes all groups and quantiles at once:
     ```
-    median_SD_spread = data.groupby('date').apply(
-        lambda x: weighted_quantile(x['rate_SD_spread'], 0.5, sample_weight=x['Volume']))
+    median_SD_spread = groupby_weighted_quantile(
+        data, value_col='rate_SD_spread', weight_col='Volume', by_col='date',
+        quantiles=[0.5])[0.5]
     ```
     """
     values = np.array(values)
@@ -426,20 +884,196 @@ def weighted_quantile(
     return np.interp(quantiles, weighted_quantiles, values)
 
 
+def groupby_weighted_quantile(
+    data=None,
+    value_col=None,
+    weight_col=None,
+    by_col=None,
+    quantiles=[0.5],
+    old_style=False,
+):
+    """Weighted quantiles of `value_col` for every group of `by_col`.
+
+    Gives the same result as calling `weighted_quantile` on each group,
+    but all groups are handled in one vectorized pass: the data are sorted
+    once by (group, value), the cumulative weights are computed within each
+    group segment and every requested quantile is interpolated for every
+    group at the same time.
+
+    Parameters
+    ----------
+    data : pandas.DataFrame
+    value_col : str
+        Column with the values
+    weight_col : str
+        Column with the sample weights
+    by_col : str or list of str
+        Column(s) to group by
+    quantiles : array-like
+        Quantiles to compute, each in [0, 1]
+    old_style : bool, Default False
+        if True, will correct output to be consistent with numpy.percentile.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by the groups, with one column per quantile. Rows with a
+        missing value or weight are ignored. Groups with no positive total
+        weight give NaN.
+
+    Examples
+    --------
+
+    ```
+    >>> df = pd.DataFrame({
+    ...     'date': ['2020-01-01'] * 3 + ['2020-01-02'] * 4,
+    ...     'rate': [1, 2, 3, 4, 1, 2, 3],
+    ...     'volume': [1, 1, 1, 1, 1, 1, 1],
+    ... })
+    >>> groupby_weighted_quantile(df, value_col='rate', weight_col='volume', by_col='date', quantiles=[0.25, 0.5, 0.75])  # doctest: +NORMALIZE_WHITESPACE
+                0.25  0.50  0.75
+    date
+    2020-01-01  1.25   2.0  2.75
+    2020-01-02  1.50   2.5  3.50
+
+    ```
+    """
+    quantiles = np.atleast_1d(np.asarray(quantiles, dtype=float))
+    assert np.all(quantiles >= 0) and np.all(
+        quantiles <= 1
+    ), "quantiles should be in [0, 1]"
+
+    grouped = data.groupby(_groupby_keys(data, by_col), sort=True)
+    group_index = grouped.size().index
+    n_groups = len(group_index)
+    n_quantiles = len(quantiles)
+
+    codes = grouped.ngroup().to_numpy()
+    values = data[value_col].to_numpy(dtype=float)
+    weights = data[weight_col].to_numpy(dtype=float)
+    keep = (codes >= 0) & ~np.isnan(values) & ~np.isnan(weights)
+    codes, values, weights = codes[keep], values[keep], weights[keep]
+
+    # One global sort by (group, value)
+    sorter = np.lexsort((values, codes))
+    codes, values, weights = codes[sorter], values[sorter], weights[sorter]
+
+    counts = np.bincount(codes, minlength=n_groups)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    totals = np.bincount(codes, weights=weights, minlength=n_groups)
+
+    cum_weights = pd.Series(weights).groupby(codes).cumsum().to_numpy()
+    weighted_quantiles = cum_weights - 0.5 * weights
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if old_style:
+            # To be convenient with numpy.percentile
+            first = weighted_quantiles[np.minimum(starts, len(codes) - 1)]
+            last = weighted_quantiles[np.maximum(ends - 1, 0)]
+            spread = last - first
+            weighted_quantiles = (weighted_quantiles - first[codes]) / spread[codes]
+        else:
+            weighted_quantiles = weighted_quantiles / totals[codes]
+    weighted_quantiles[~np.isfinite(weighted_quantiles)] = 0.0
+
+    result = np.full((n_groups, n_quantiles), np.nan)
+    valid_groups = np.flatnonzero((counts > 0) & (totals > 0))
+    if len(valid_groups) > 0:
+        # Offset each group's cumulative weights (which lie in [0, 1]) by
+        # twice the group number, so that a single searchsorted locates
+        # every quantile within its own group segment.
+        sort_key = 2.0 * codes + weighted_quantiles
+        q_groups = np.repeat(valid_groups, n_quantiles)
+        q = np.tile(quantiles, len(valid_groups))
+        pos = np.searchsorted(sort_key, 2.0 * q_groups + q, side="right") - 1
+
+        start = starts[q_groups]
+        end = ends[q_groups] - 1
+        lo = np.clip(pos, start, end)
+        hi = np.minimum(lo + 1, end)
+        x0, x1 = weighted_quantiles[lo], weighted_quantiles[hi]
+        y0, y1 = values[lo], values[hi]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            interpolated = y0 + (q - x0) / (x1 - x0) * (y1 - y0)
+        interpolated = np.where(
+            (hi == lo) | (x0 == q) | ~np.isfinite(interpolated), y0, interpolated
+        )
+        # Like np.interp, hold the end values outside of the range
+        interpolated = np.where(pos < start, values[start], interpolated)
+        interpolated = np.where(pos >= end, values[end], interpolated)
+        result[valid_groups] = interpolated.reshape(len(valid_groups), n_quantiles)
+
+    return pd.DataFrame(result, index=group_index, columns=list(quantiles))
+
+
 _alphabet = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ*@#"
 
+# Lookup table from ASCII code to the CUSIP value of the character (-1 if invalid)
+_alphabet_lookup = np.full(256, -1, dtype=np.int16)
+_alphabet_lookup[np.frombuffer(_alphabet.encode("ascii"), dtype=np.uint8)] = np.arange(
+    len(_alphabet)
+)
+# Alternating weights 1, 2, 1, 2, ... of the 8 characters
+_cusip_weights = np.array([1, 2, 1, 2, 1, 2, 1, 2], dtype=np.int16)
+
+
+def _cusips_to_char_values(cusips, width):
+    """Decode fixed-width ASCII CUSIPs into a matrix of CUSIP character values.
+
+    Returns an (n, width) int matrix, where characters outside of the CUSIP
+    alphabet are -1, and a boolean array flagging rows that are not strings
+    of exactly `width` characters.
+    """
+    cusips = pd.Series(np.asarray(cusips, dtype=object).ravel())
+    if pd.api.types.infer_dtype(cusips, skipna=False) == "string":
+        is_str = np.ones(len(cusips), dtype=bool)
+    else:
+        is_str = cusips.map(type).eq(str).to_numpy()
+        cusips = cusips.where(is_str, "")
+    try:
+        encoded = np.asarray(cusips, dtype="S")
+    except UnicodeEncodeError:
+        encoded = np.asarray(cusips.str.encode("ascii", errors="replace"), dtype="S")
+    itemsize = max(encoded.dtype.itemsize, width)
+    chars = (
+        encoded.astype(f"S{itemsize}").view(np.uint8).reshape(len(encoded), itemsize)
+    )
+    bad_length = ~is_str | (chars[:, :width] == 0).any(axis=1)
+    bad_length |= (chars[:, width:] != 0).any(axis=1)
+    return _alphabet_lookup[chars[:, :width]], bad_length
+
+
+def _check_digits_from_char_values(char_values):
+    # Multiply by the alternating weights, then sum the individual digits
+    products = char_values[:, :8] * _cusip_weights
+    digit_sum = (products // 10 + products % 10).sum(axis=1)
+    return (10 - digit_sum % 10) % 10
+
 
-@np.vectorize
 def calc_check_digit(number):
     """Calculate the check digits for the 8-digit cusip.
-    This function is taken from
+    This function is adapted from
     https://github.com/arthurdejong/python-stdnum/blob/master/stdnum/cusip.py
+
+    The CUSIPs are decoded into a uint8 matrix of ASCII codes and mapped
+    through a lookup table, so that the weighting and digit sums are done
+    with NumPy operations for all CUSIPs at once.
+
+    ```
+    >>> calc_check_digit('03783310')
+    '0'
+    >>> calc_check_digit(['03783310', '17275R10'])
+    array(['0', '2'], dtype='<U1')
+
+    ```
     """
-    # convert to numeric first, then sum individual digits
-    number = "".join(
-        str((1, 2)[i % 2] * _alphabet.index(n)) for i, n in enumerate(number)
-    )
-    return str((10 - sum(int(n) for n in number)) % 10)
+    char_values, bad_length = _cusips_to_char_values(number, width=8)
+    if bad_length.any() or (char_values < 0).any():
+        raise ValueError("CUSIPs must be 8 characters from the CUSIP alphabet")
+    check_digits = _check_digits_from_char_values(char_values).astype("U1")
+    if np.ndim(number) == 0:
+        return check_digits[0]
+    return check_digits
 
 
 def convert_cusips_from_8_to_9_digit(cusip_8dig_series):
@@ -448,45 +1082,59 @@ def convert_cusips_from_8_to_9_digit(cusip_8dig_series):
     return new9
 
 
-def _with_lagged_column_no_resample(
-    df=None,
-    columns_to_lag=None,
-    id_columns=None,
-    lags=1,
-    # date_col="date",
-    prefix="L",
-):
-    """This can be easily accomplished with the shift method. For example,
+def validate_cusips(cusips):
+    """Flag valid 9-digit CUSIPs.
+
+    Returns a boolean numpy array that is True where the CUSIP has
+    9 characters from the CUSIP alphabet and a correct check digit.
+    Missing and malformed values are flagged as invalid rather than
+    raising an error.
 
     ```
-    df.groupby("id")["value"].shift(1)
-    ```
+    >>> validate_cusips(pd.Series(['037833100', '037833101', '0378331', None]))
+    array([ True, False, False, False])
 
-    This function is
-    to remind myself of this older method.
+    ```
     """
+    char_values, bad_length = _cusips_to_char_values(cusips, width=9)
+    bad_chars = (char_values[:, :8] < 0).any(axis=1)
+    check_digits = _check_digits_from_char_values(np.maximum(char_values, 0))
+    return ~bad_length & ~bad_chars & (check_digits == char_values[:, 8])
 
-    ## Old Method
-    # all_dates = df[date_col].drop_duplicates().sort_values().reset_index(drop=True)
-    # date_to_lag_date = pd.concat([all_dates, all_dates.shift(-lags)], axis=1)
-    # date_to_lag_date.columns = [date_col, '_lagged_date']
 
-    # sub_df = df[[date_col, *id_columns, *columns_to_lag]]
-    # lag_sub_df = sub_df.merge(date_to_lag_date, on=[date_col])
+def calc_check_digit_expr(expr):
+    """Polars expression computing the check digit of 8-digit CUSIPs.
 
-    # for col in columns_to_lag:
-    #     lag_sub_df = lag_sub_df.rename(columns={col: f'{prefix}{lags}_' + col})
+    `expr` is a polars expression or column name. The result is a string
+    expression that is null where the CUSIP has an invalid character.
 
-    # lag_sub_df = lag_sub_df.drop(columns=[date_col])
-    # lag_sub_df = lag_sub_df.rename(columns={'_lagged_date':date_col})
-
-    ## New Method
-    subsub_df = df.groupby(id_columns)[columns_to_lag].shift(lags)
-    lag_sub_df = df.copy()
-    for col in columns_to_lag:
-        lag_sub_df[f"{prefix}{lags}_{col}"] = subsub_df[col]
+    ```
+    >>> df = pl.DataFrame({'cusip': ['03783310', '17275R10']})
+    >>> df.with_columns(cusip9=pl.col('cusip') + calc_check_digit_expr('cusip'))['cusip9'].to_list()
+    ['037833100', '17275R102']
 
-    return lag_sub_df
+    ```
+    """
+    if isinstance(expr, str):
+        expr = pl.col(expr)
+    mapping = {char: value for value, char in enumerate(_alphabet)}
+    digit_sum = pl.lit(0, dtype=pl.Int32)
+    for i, weight in enumerate(_cusip_weights):
+        product = expr.str.slice(i, 1).replace_strict(
+            mapping, default=None, return_dtype=pl.Int32
+        ) * int(weight)
+        digit_sum = digit_sum + product // 10 + product % 10
+    return ((10 - digit_sum % 10) % 10).cast(pl.String)
+
+
+def validate_cusips_expr(expr):
+    """Polars expression flagging valid 9-digit CUSIPs. See `validate_cusips`."""
+    if isinstance(expr, str):
+        expr = pl.col(expr)
+    is_valid = (expr.str.len_chars() == 9) & (
+        calc_check_digit_expr(expr) == expr.str.slice(8, 1)
+    )
+    return is_valid.fill_null(False)
 
 
 def with_lagged_columns(
@@ -502,6 +1150,18 @@ def with_lagged_columns(
     """
     Add lagged columns to a dataframe, respecting frequency of the data.
 
+    Works in long format: the dates are mapped onto the `freq` grid as
+    integer period numbers and, within each id, a value is taken as the lag
+    only if it lies exactly `lags` periods earlier. Gaps in the data are
+    thus respected without pivoting to a dense date by id matrix. If several
+    observations of an id fall in the same period, the last one is used as
+    the value of that period.
+
+    `column_to_lag` and `id_column` may be a column name or a list of column
+    names, and `lags` may be an int or a list of ints (negative values give
+    leads). A column named f"{prefix}{lag}_{column}" is added for each
+    combination. The result is sorted by id and date.
+
     Examples
     --------
 
@@ -532,18 +1192,18 @@ def with_lagged_columns(
     7  B 1990-04-01      4
     8  B 1990-06-01      6
 
-    >>> df_lag = _with_lagged_column_no_resample(df=df, columns_to_lag=['value'], id_columns=['id'], lags=1)
+    >>> df_lag = with_lagged_columns(df=df, column_to_lag='value', id_column='id', lags=1, resample=False)
     >>> df_lag
       id       date  value  L1_value
     0  A 1990-01-01      1       NaN
-    1  A 1990-02-01      2      1.00
-    2  A 1990-03-01      3      2.00
+    1  A 1990-02-01      2       1.0
+    2  A 1990-03-01      3       2.0
     3  B 1989-12-01     12       NaN
-    4  B 1990-01-01      1     12.00
-    5  B 1990-02-01      2      1.00
-    6  B 1990-03-01      3      2.00
-    7  B 1990-04-01      4      3.00
-    8  B 1990-06-01      6      4.00
+    4  B 1990-01-01      1      12.0
+    5  B 1990-02-01      2       1.0
+    6  B 1990-03-01      3       2.0
+    7  B 1990-04-01      4       3.0
+    8  B 1990-06-01      6       4.0
 
     The issue with leaving out the resample is that the lagged value
     for 1990-06-01 is 4.0, but it should be NaN. This is because the
@@ -553,18 +1213,31 @@ def with_lagged_columns(
 
     >>> df_lag = with_lagged_columns(df=df, column_to_lag='value', id_column='id', lags=1, freq="MS", resample=True)
     >>> df_lag
-       id       date  value  L1_value
-    2   A 1990-01-01   1.00       NaN
-    4   A 1990-02-01   2.00      1.00
-    6   A 1990-03-01   3.00      2.00
-    8   A 1990-04-01    NaN      3.00
-    1   B 1989-12-01  12.00       NaN
-    3   B 1990-01-01   1.00     12.00
-    5   B 1990-02-01   2.00      1.00
-    7   B 1990-03-01   3.00      2.00
-    9   B 1990-04-01   4.00      3.00
-    11  B 1990-05-01    NaN      4.00
-    13  B 1990-06-01   6.00       NaN
+      id       date  value  L1_value
+    0  A 1990-01-01      1       NaN
+    1  A 1990-02-01      2       1.0
+    2  A 1990-03-01      3       2.0
+    3  B 1989-12-01     12       NaN
+    4  B 1990-01-01      1      12.0
+    5  B 1990-02-01      2       1.0
+    6  B 1990-03-01      3       2.0
+    7  B 1990-04-01      4       3.0
+    8  B 1990-06-01      6       NaN
+
+    Several columns and lags can be built in one call:
+
+    >>> df_lag = with_lagged_columns(df=df, column_to_lag=['value'], id_column='id', lags=[1, 2, -1], freq="MS")
+    >>> df_lag
+      id       date  value  L1_value  L2_value  L-1_value
+    0  A 1990-01-01      1       NaN       NaN        2.0
+    1  A 1990-02-01      2       1.0       NaN        3.0
+    2  A 1990-03-01      3       2.0       1.0        NaN
+    3  B 1989-12-01     12       NaN       NaN        1.0
+    4  B 1990-01-01      1      12.0       NaN        2.0
+    5  B 1990-02-01      2       1.0      12.0        3.0
+    6  B 1990-03-01      3       2.0       1.0        4.0
+    7  B 1990-04-01      4       3.0       2.0        NaN
+    8  B 1990-06-01      6       NaN       4.0        NaN
 
     ```
 
@@ -596,29 +1269,229 @@ def with_lagged_columns(
     as seen here: https://business-science.github.io/pytimetk/guides/03_pandas_frequency.html
 
     """
+    columns_to_lag = (
+        [column_to_lag] if isinstance(column_to_lag, str) else list(column_to_lag)
+    )
+    id_columns = [id_column] if isinstance(id_column, str) else list(id_column)
+    lags = [lags] if np.ndim(lags) == 0 else list(lags)
+
     if resample:
-        df_wide = df.pivot(index=date_col, columns=id_column, values=column_to_lag)
-        new_col = f"{prefix}{lags}_{column_to_lag}"
-        df_resampled = df_wide.resample(freq).last()
-        df_lagged = df_resampled.shift(lags)
-        df_lagged = df_lagged.stack(dropna=False).reset_index(name=new_col)
-        df_lagged = df.merge(df_lagged, on=[date_col, id_column], how="right")
-        df_lagged = df_lagged.dropna(subset=[column_to_lag, new_col], how="all")
-        df_lagged = df_lagged.sort_values(by=[id_column, date_col])
+        if freq is None:
+            raise ValueError("freq must be given when resample=True")
+        ids = df.groupby(id_columns, sort=True).ngroup().to_numpy()
+
+        # Map dates onto the frequency grid as integer period numbers. The
+        # grouper numbers the bins consecutively, including empty ones.
+        date_codes, unique_dates = pd.factorize(df[date_col], sort=True)
+        unique_periods = (
+            pd.Series(unique_dates, index=unique_dates)
+            .groupby(pd.Grouper(freq=freq))
+            .ngroup()
+            .to_numpy()
+        )
+        valid = (ids >= 0) & (date_codes >= 0)
+        periods = np.where(valid, unique_periods[date_codes], 0)
+
+        sorter = np.lexsort((date_codes, ids))
+        df_lagged = df.take(sorter)
+        ids, periods, valid = ids[sorter], periods[sorter], valid[sorter]
+
+        # Unique, sorted (id, period) keys, padded so that shifting a key by
+        # up to max_lag periods never reaches into a neighbouring id
+        max_lag = max(abs(lag) for lag in lags)
+        span = int(periods.max(initial=0)) + 1 + 2 * max_lag
+        keys = ids.astype(np.int64) * span + periods + max_lag
+        is_last_in_period = valid & np.append(keys[1:] != keys[:-1], True)
+        last_positions = np.flatnonzero(is_last_in_period)
+        last_keys = keys[last_positions]
+
+        for lag in lags:
+            target_keys = keys - lag
+            found_at = np.searchsorted(last_keys, target_keys)
+            found_at = np.minimum(found_at, max(len(last_keys) - 1, 0))
+            if len(last_keys) > 0:
+                found = valid & (last_keys[found_at] == target_keys)
+                source = last_positions[found_at]
+            else:
+                found = np.zeros(len(keys), dtype=bool)
+                source = np.zeros(len(keys), dtype=np.intp)
+            for col in columns_to_lag:
+                lagged = df_lagged[col].iloc[source].where(found)
+                df_lagged[f"{prefix}{lag}_{col}"] = lagged.set_axis(df_lagged.index)
     else:
-        df_lagged = _with_lagged_column_no_resample(
+        df_lagged = with_panel_lags(
             df=df,
-            columns_to_lag=[column_to_lag],
-            id_columns=[id_column],
-            lags=lags,
+            columns=columns_to_lag,
+            id_columns=id_columns,
             date_col=date_col,
+            lags=lags,
             prefix=prefix,
         )
 
     return df_lagged
 
 
-def leave_one_out_sums(df, groupby=[], summed_col=""):
+def with_panel_lags(
+    df=None,
+    columns=None,
+    id_columns=None,
+    date_col="date",
+    lags=[1],
+    prefix="L",
+    library="pandas",
+):
+    """
+    Add lags and leads of several columns of a panel in one pass.
+
+    Unlike `with_lagged_columns`, this does not respect the frequency of the
+    data: the lag is the previous observation of the same id, as with
+    `df.groupby(id_columns)[columns].shift(lag)`. The data are sorted once by
+    id and `date_col` (or kept in their current order if `date_col` is None)
+    and every lag of every column is taken from that single sort. Negative
+    lags give leads. A column named f"{prefix}{lag}_{column}" is added for
+    each combination.
+
+    The result is sorted by id and date. With library="pandas", the original
+    index is kept and the input frame is copied only once, when it is sorted.
+    With library="polars", `df` may be a DataFrame or a LazyFrame (the same
+    type is returned).
+
+    Examples
+    --------
+
+    ```
+    >>> df = pd.DataFrame({
+    ...     'id': ['A', 'A', 'A', 'B', 'B'],
+    ...     'date': pd.to_datetime(['1990-03-01', '1990-01-01', '1990-02-01',
+    ...                             '1990-01-01', '1990-02-01']),
+    ...     'value': [3, 1, 2, 10, 20],
+    ... })
+    >>> with_panel_lags(df=df, columns=['value'], id_columns=['id'], lags=[1, 2, -1])
+      id       date  value  L1_value  L2_value  L-1_value
+    1  A 1990-01-01      1       NaN       NaN        2.0
+    2  A 1990-02-01      2       1.0       NaN        3.0
+    0  A 1990-03-01      3       2.0       1.0        NaN
+    3  B 1990-01-01     10       NaN       NaN       20.0
+    4  B 1990-02-01     20      10.0       NaN        NaN
+
+    ```
+    """
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    id_columns = [id_columns] if isinstance(id_columns, str) else list(id_columns)
+    lags = [lags] if np.ndim(lags) == 0 else list(lags)
+
+    if library == "pandas":
+        ids = df.groupby(id_columns, sort=True).ngroup().to_numpy()
+        if date_col is None:
+            sorter = np.argsort(ids, kind="stable")
+        else:
+            sorter = np.lexsort((df[date_col].to_numpy(), ids))
+        ids = ids[sorter]
+        df_sorted = df.take(sorter)
+
+        new_columns = {}
+        for lag in lags:
+            same_id = ids >= 0
+            same_id &= pd.Series(ids).shift(lag).eq(ids).to_numpy()
+            for col in columns:
+                lagged = df_sorted[col].shift(lag).where(same_id)
+                new_columns[f"{prefix}{lag}_{col}"] = lagged
+        df_lagged = pd.concat(
+            [df_sorted, pd.DataFrame(new_columns, index=df_sorted.index)],
+            axis=1,
+            copy=False,
+        )
+
+    elif library == "polars":
+        sort_cols = id_columns if date_col is None else [*id_columns, date_col]
+
+        def same_id(lag):
+            return pl.all_horizontal(
+                pl.col(id_col).shift(lag) == pl.col(id_col) for id_col in id_columns
+            )
+
+        # After sorting, a lag is a plain shift, kept only within the same id
+        df_lagged = (
+            df.lazy()
+            .sort(sort_cols, maintain_order=True)
+            .with_columns(
+                pl.when(same_id(lag))
+                .then(pl.col(col).shift(lag))
+                .alias(f"{prefix}{lag}_{col}")
+                for lag in lags
+                for col in columns
+            )
+        )
+        if isinstance(df, pl.DataFrame):
+            df_lagged = df_lagged.collect()
+
+    else:
+        raise ValueError("Unknown library")
+
+    return df_lagged
+
+
+def _leave_one_out_totals(df, groupby, cols, weight_col=None, library="pandas"):
+    """Leave-one-out sums and counts of non-missing values of `cols`.
+
+    With `weight_col`, the sums are weighted and the counts are replaced by the
+    sums of the weights of the non-missing values.
+    """
+    if library == "pandas":
+        keys = _groupby_keys(df, groupby)
+        values = df[cols]
+        not_missing = values.notna()
+        if weight_col is None:
+            counts = not_missing.astype(int)
+        else:
+            weights = df[weight_col]
+            values = values.mul(weights, axis=0)
+            counts = not_missing.mul(weights, axis=0)
+        sums = values.fillna(0)
+        loo_sums = sums.groupby(keys).transform("sum") - sums
+        loo_counts = counts.groupby(keys).transform("sum") - counts
+
+    elif library == "polars":
+        df = df.lazy()
+        if weight_col is None:
+            weights = pl.lit(1)
+        else:
+            weights = pl.col(weight_col)
+
+        def weighted(col):
+            return (pl.col(col) * weights).fill_null(0)
+
+        def weight_where_not_missing(col):
+            return pl.when(pl.col(col).is_not_null()).then(weights).otherwise(0)
+
+        loo_sums = df.select(
+            (weighted(col).sum().over(groupby) - weighted(col)).alias(col)
+            for col in cols
+        ).collect()
+        loo_counts = df.select(
+            (
+                weight_where_not_missing(col).sum().over(groupby)
+                - weight_where_not_missing(col)
+            ).alias(col)
+            for col in cols
+        ).collect()
+
+    else:
+        raise ValueError("Unknown library")
+
+    return loo_sums, loo_counts
+
+
+def _leave_one_out_result(result, cols, library):
+    # A single column name gives a Series, a list of names gives a frame
+    if isinstance(cols, str):
+        return result[cols] if library == "pandas" else result.to_series(0)
+    return result
+
+
+def leave_one_out_sums(
+    df, groupby=[], summed_col="", weight_col=None, library="pandas"
+):
     """
     Compute leave-one-out sums,
 
@@ -627,6 +1500,14 @@ def leave_one_out_sums(df, groupby=[], summed_col=""):
     This is helpful for constructing the shift-share instruments
     in Borusyak, Hull, Jaravel (2022).
 
+    The sums are computed as the group total minus the own value, so no
+    Python function is called per group. `summed_col` may be a list of
+    columns, in which case a frame is returned. Missing values are skipped:
+    a row with a missing value gets the sum of the other values in its group.
+    With `weight_col`, the weighted sum $\\sum_{j \\neq i} w_j x_j$ is computed.
+    With library="polars", `df` is a polars DataFrame or LazyFrame and a
+    polars Series (or DataFrame) is returned.
+
     Examples
     --------
 
@@ -650,33 +1531,197 @@ def leave_one_out_sums(df, groupby=[], summed_col=""):
     ...     s,
     ...     check_names=False)
 
+    >>> leave_one_out_sums(df, groupby=['B'], summed_col=['C', 'D'])
+        C     D
+    0  10  13.0
+    1   6  10.0
+    2   6   7.0
+    3   8  11.0
+    4   5  10.0
+    5   7   3.0
+
+    ```
+
+    """
+    cols = [summed_col] if isinstance(summed_col, str) else list(summed_col)
+    loo_sums, _ = _leave_one_out_totals(
+        df, groupby, cols, weight_col=weight_col, library=library
+    )
+    return _leave_one_out_result(loo_sums, summed_col, library)
+
+
+def leave_one_out_counts(df, groupby=[], count_col="", library="pandas"):
+    """
+    Compute leave-one-out counts: the number of non-missing values of
+    `count_col` in the group, excluding the own row. See `leave_one_out_sums`.
+
+    ```
+    >>> df = pd.DataFrame({'B': ['one', 'one', 'one', 'two'], 'C': [1, None, 5, 2]})
+    >>> leave_one_out_counts(df, groupby=['B'], count_col='C')
+    0    1
+    1    2
+    2    1
+    3    0
+    Name: C, dtype: int64
+
+    ```
+    """
+    cols = [count_col] if isinstance(count_col, str) else list(count_col)
+    _, loo_counts = _leave_one_out_totals(df, groupby, cols, library=library)
+    return _leave_one_out_result(loo_counts, count_col, library)
+
+
+def leave_one_out_means(df, groupby=[], mean_col="", weight_col=None, library="pandas"):
+    """
+    Compute leave-one-out means: the (weighted) mean of the non-missing values
+    of `mean_col` in the group, excluding the own row. Rows without any other
+    non-missing value in their group get NaN. See `leave_one_out_sums`.
+
+    ```
+    >>> df = pd.DataFrame({'B': ['one', 'one', 'one', 'two'], 'C': [1, None, 5, 2]})
+    >>> leave_one_out_means(df, groupby=['B'], mean_col='C')
+    0    5.0
+    1    3.0
+    2    1.0
+    3    NaN
+    Name: C, dtype: float64
+
+    ```
+    """
+    cols = [mean_col] if isinstance(mean_col, str) else list(mean_col)
+    loo_sums, loo_counts = _leave_one_out_totals(
+        df, groupby, cols, weight_col=weight_col, library=library
+    )
+    if library == "pandas":
+        loo_means = loo_sums / loo_counts.where(loo_counts != 0)
+    else:
+        nonzero_counts = loo_counts.select(
+            pl.when(pl.col(col) != 0).then(pl.col(col)).alias(col) for col in cols
+        )
+        loo_means = loo_sums / nonzero_counts
+    return _leave_one_out_result(loo_means, mean_col, library)
+
+
+def step_function_overlay(index, steps, before=np.nan):
+    """Align a step function onto a date index.
+
+    `steps` gives the value that takes effect on each date and holds until
+    the next one. It can be a dict or Series mapping effective dates to
+    values, or a DataFrame indexed by effective date (one step function per
+    column). Dates in `index` before the first effective date, or all dates
+    if `steps` is empty, get `before`.
+    The whole index is aligned with one `searchsorted`, without adding rows
+    for effective dates that are not in `index`.
+
+    Examples
+    --------
+
+    ```
+    >>> index = pd.date_range("2021-01-01", periods=5, freq="MS")
+    >>> step_function_overlay(index, {"2021-Feb-15": 80, "2021-Apr-1": 160})
+    2021-01-01      NaN
+    2021-02-01      NaN
+    2021-03-01     80.0
+    2021-04-01    160.0
+    2021-05-01    160.0
+    Freq: MS, dtype: float64
+
     ```
+    """
+    if isinstance(steps, dict):
+        steps = pd.Series(steps)
+    steps = steps.set_axis([pd.Timestamp(date) for date in steps.index]).sort_index()
+
+    index = pd.DatetimeIndex(index)
+    if len(steps) == 0:
+        if isinstance(steps, pd.DataFrame):
+            return pd.DataFrame(before, index=index, columns=steps.columns)
+        return pd.Series(before, index=index, name=steps.name)
+    positions = steps.index.searchsorted(index, side="right") - 1
+    has_value = positions >= 0
+    values = steps.iloc[np.where(has_value, positions, 0)]
+    if isinstance(steps, pd.DataFrame):
+        result = pd.DataFrame(values.to_numpy(), index=index, columns=steps.columns)
+        has_value = np.broadcast_to(has_value[:, None], result.shape)
+    else:
+        result = pd.Series(values.to_numpy(), index=index, name=steps.name)
+    return result.where(has_value, before)
+
 
+def _apply_to_dates(d, array_func, expr_func):
+    """Apply a date calculation to a scalar or to a whole array of dates.
+
+    `array_func` maps a numpy datetime64 array to a datetime64 array and
+    `expr_func` maps a polars expression to a polars expression. Series and
+    DatetimeIndex inputs keep their index and name. Scalars give a Timestamp.
+    Time zone aware dates are handled in their local wall time, and the
+    results are localized to the same time zone.
     """
-    s = df.groupby(groupby)[summed_col].transform(lambda x: x.sum() - x)
-    return s
+    if isinstance(d, pl.Expr):
+        return expr_func(d)
+    if isinstance(d, pd.Series):
+        tz = d.dt.tz
+        values = array_func(d.dt.tz_localize(None).to_numpy(dtype="datetime64[ns]"))
+        return pd.Series(values, index=d.index, name=d.name).dt.tz_localize(tz)
+    if isinstance(d, pd.DatetimeIndex):
+        values = array_func(d.tz_localize(None).to_numpy())
+        return pd.DatetimeIndex(values, name=d.name).tz_localize(d.tz)
+    if np.ndim(d) == 0:
+        d = pd.Timestamp(d)
+        values = np.array([d.tz_localize(None).to_datetime64()], dtype="datetime64[ns]")
+        return pd.Timestamp(array_func(values)[0]).tz_localize(d.tz)
+    return array_func(np.asarray(d, dtype="datetime64[ns]"))
+
+
+def _quarter_start_months(values):
+    # Months since 1970-01, which is the start of a quarter
+    months = values.astype("datetime64[M]")
+    return months - months.astype(np.int64) % 3
+
+
+def _days_to_ns(days):
+    return days.astype("datetime64[ns]")
 
 
 def get_most_recent_quarter_end(d):
     """
     Take a datetime and find the most recent quarter end date
 
+    `d` may also be a Series, DatetimeIndex or numpy datetime64 array, or a
+    polars expression, in which case all dates are handled at once with
+    period arithmetic.
+
     ```
     >>> d = pd.to_datetime('2019-10-21')
     >>> get_most_recent_quarter_end(d)
     datetime.datetime(2019, 9, 30, 0, 0)
 
+    >>> get_most_recent_quarter_end(pd.Series(pd.to_datetime(['2019-10-21', '2020-03-31'])))
+    0   2019-09-30
+    1   2019-12-31
+    dtype: datetime64[ns]
+
     ```
     """
-    quarter_month = (d.month - 1) // 3 * 3 + 1
-    quarter_end = datetime.datetime(d.year, quarter_month, 1) - relativedelta(days=1)
-    return quarter_end
+    result = _apply_to_dates(
+        d,
+        lambda values: _days_to_ns(
+            _quarter_start_months(values).astype("datetime64[D]") - 1
+        ),
+        lambda expr: expr.dt.truncate("1q").dt.truncate("1d").dt.offset_by("-1d"),
+    )
+    if isinstance(result, pd.Timestamp):
+        return result.to_pydatetime()
+    return result
 
 
 def get_next_quarter_start(d):
     """
     Take a datetime and find the start date of the next quarter
 
+    Also accepts arrays of dates and polars expressions. See
+    `get_most_recent_quarter_end`.
+
     ```
     >>> d = pd.to_datetime('2019-10-21')
     >>> get_next_quarter_start(d)
@@ -684,11 +1729,16 @@ def get_next_quarter_start(d):
 
     ```
     """
-    quarter_month = (d.month - 1) // 3 * 3 + 4
-    years_to_add = quarter_month // 12
-    quarter_month_mod = quarter_month % 12
-    quarter_start = datetime.datetime(d.year + years_to_add, quarter_month_mod, 1)
-    return quarter_start
+    result = _apply_to_dates(
+        d,
+        lambda values: _days_to_ns(
+            (_quarter_start_months(values) + 3).astype("datetime64[D]")
+        ),
+        lambda expr: expr.dt.truncate("1q").dt.truncate("1d").dt.offset_by("1q"),
+    )
+    if isinstance(result, pd.Timestamp):
+        return result.to_pydatetime()
+    return result
 
 
 def get_end_of_current_month(d):
@@ -696,6 +1746,9 @@ def get_end_of_current_month(d):
     Take a datetime and find the last date of the current month
     and also reset time to zero.
 
+    Also accepts arrays of dates and polars expressions. See
+    `get_most_recent_quarter_end`.
+
     ```
     >>> d = pd.to_datetime('2019-10-21')
     >>> get_end_of_current_month(d)
@@ -706,17 +1759,14 @@ def get_end_of_current_month(d):
     Timestamp('2023-03-31 00:00:00')
 
     ```
-
-    From https://stackoverflow.com/a/13565185
     """
-    # Reset tiem part of datetime to zero: https://stackoverflow.com/a/26883852
-    d = pd.DatetimeIndex([d]).normalize()[0]
-
-    # The day 28 exists in every month. 4 days later, it's always next month
-    next_month = d.replace(day=28) + datetime.timedelta(days=4)
-    # subtracting the number of the current day brings us back one month
-    end_of_current_month = next_month - datetime.timedelta(days=next_month.day)
-    return end_of_current_month
+    return _apply_to_dates(
+        d,
+        lambda values: _days_to_ns(
+            (values.astype("datetime64[M]") + 1).astype("datetime64[D]") - 1
+        ),
+        lambda expr: expr.dt.truncate("1d").dt.month_end(),
+    )
 
 
 def get_end_of_current_quarter(d):
@@ -724,6 +1774,9 @@ def get_end_of_current_quarter(d):
     Take a datetime and find the last date of the current quarter
     and also reset time to zero.
 
+    Also accepts arrays of dates and polars expressions. See
+    `get_most_recent_quarter_end`.
+
     ```
     >>> d = pd.to_datetime('2019-10-21')
     >>> get_end_of_current_quarter(d)
@@ -737,9 +1790,19 @@ def get_end_of_current_quarter(d):
 
     ```
     """
-    quarter_start = get_next_quarter_start(d)
-    quarter_end = quarter_start - datetime.timedelta(days=1)
-    return quarter_end
+    result = _apply_to_dates(
+        d,
+        lambda values: _days_to_ns(
+            (_quarter_start_months(values) + 3).astype("datetime64[D]") - 1
+        ),
+        lambda expr: expr.dt.truncate("1q")
+        .dt.truncate("1d")
+        .dt.offset_by("1q")
+        .dt.offset_by("-1d"),
+    )
+    if isinstance(result, pd.Timestamp):
+        return result.to_pydatetime()
+    return result
 
 
 def add_vertical_lines_to_plot(
@@ -790,6 +1853,7 @@ def plot_weighted_median_with_distribution_bars(
     ylabel=None,
     xlabel=None,
     label=None,
+    return_data=False,
 ):
     """Plot the weighted median of a variable over time. Optionally, plot the 25th and 75th percentiles
 
@@ -837,50 +1901,60 @@ def plot_weighted_median_with_distribution_bars(
     plt.legend()
     ```
 
+    To reuse the computed series without recomputing them, pass
+    `return_data=True`:
+
+    ```
+    ax, quantile_df = plot_weighted_median_with_distribution_bars(
+            data=df,
+            variable_name='rate_SD_spread',
+            date_col='date',
+            weight_col='Volume',
+            return_data=True,
+            )
+    ```
+
     Notes
     -----
     rolling_window=1 means that there is no rolling aggregation applied.
 
+    The median and percentiles are computed together with
+    `groupby_weighted_quantile`. With `return_data=True`, the function returns
+    `(ax, quantile_df)`, where `quantile_df` is indexed by `date_col` and has
+    the plotted (smoothed and rescaled) columns "median" and, if
+    `percentile_bars`, "lower" and "upper".
+
 
     """
     if ax is None:
         plt.clf()
         _, ax = plt.subplots()
 
-    median_series = data.groupby(date_col).apply(
-        lambda x: weighted_quantile(x[variable_name], 0.5, sample_weight=x[weight_col])
+    # Compute the median and the percentile band in one grouped pass
+    quantiles = [0.5, *percentiles] if percentile_bars else [0.5]
+    quantile_df = groupby_weighted_quantile(
+        data,
+        value_col=variable_name,
+        weight_col=weight_col,
+        by_col=date_col,
+        quantiles=quantiles,
     )
+    quantile_df.columns = ["median", "lower", "upper"][: len(quantiles)]
     if rolling:
-        wavrs = median_series.rolling(
+        quantile_df = quantile_df.rolling(
             rolling_window, min_periods=rolling_min_periods
         ).mean()
-    else:
-        wavrs = median_series
-    (wavrs * rescale_factor).plot(ax=ax, label=label)
+    quantile_df = quantile_df * rescale_factor
+
+    wavrs = quantile_df["median"]
+    wavrs.plot(ax=ax, label=label)
 
     if percentile_bars:
-        lower = data.groupby(date_col).apply(
-            lambda x: weighted_quantile(
-                x[variable_name], percentiles[0], sample_weight=x[weight_col]
-            )
-        )
-        upper = data.groupby(date_col).apply(
-            lambda x: weighted_quantile(
-                x[variable_name], percentiles[1], sample_weight=x[weight_col]
-            )
-        )
-        if rolling:
-            lower = lower.rolling(
-                rolling_window, min_periods=rolling_min_periods
-            ).mean()
-            upper = upper.rolling(
-                rolling_window, min_periods=rolling_min_periods
-            ).mean()
-        ax.plot(wavrs.index, lower * rescale_factor, color="tab:blue", alpha=0.1)
-        ax.plot(wavrs.index, upper * rescale_factor, color="tab:blue", alpha=0.1)
-        ax.fill_between(
-            wavrs.index, lower * rescale_factor, upper * rescale_factor, alpha=0.2
-        )
+        lower = quantile_df["lower"]
+        upper = quantile_df["upper"]
+        ax.plot(wavrs.index, lower, color="tab:blue", alpha=0.1)
+        ax.plot(wavrs.index, upper, color="tab:blue", alpha=0.1)
+        ax.fill_between(wavrs.index, lower, upper, alpha=0.2)
 
     if add_quarter_lines:
         start_date = data[date_col].min()
@@ -903,8 +1977,667 @@ def plot_weighted_median_with_distribution_bars(
         ax.set_xlabel(xlabel)
 
     plt.tight_layout()
+    if return_data:
+        return ax, quantile_df
     return ax
 
 
+########################################################################################
+## Parquet and SQL Helpers
+########################################################################################
+
+
+def _parquet_filter(
+    date_col=None,
+    start_date=None,
+    end_date=None,
+    id_col=None,
+    ids=None,
+    filters=None,
+    year_col=None,
+):
+    expressions = []
+    if filters is not None:
+        if not isinstance(filters, pc.Expression):
+            filters = pq.filters_to_expression(filters)
+        expressions.append(filters)
+    if start_date is not None:
+        start_date = pd.Timestamp(start_date)
+        expressions.append(pc.field(date_col) >= start_date)
+        if year_col is not None:
+            expressions.append(pc.field(year_col) >= start_date.year)
+    if end_date is not None:
+        end_date = pd.Timestamp(end_date)
+        expressions.append(pc.field(date_col) <= end_date)
+        if year_col is not None:
+            expressions.append(pc.field(year_col) <= end_date.year)
+    if ids is not None:
+        expressions.append(pc.field(id_col).isin(list(ids)))
+    if not expressions:
+        return None
+    expression = expressions[0]
+    for other in expressions[1:]:
+        expression = expression & other
+    return expression
+
+
+def _restore_dataset_columns(table, columns, schema=None):
+    """Undo the changes partitioning makes to the columns of a dataset.
+
+    Partition keys are read back as the last columns, with inferred types,
+    and a "year" key derived from the date is not a column of the data. With
+    the `schema` of the written frame, its column order and types are
+    restored. Otherwise, a "year" key that was not asked for is dropped.
+    """
+    if columns is not None:
+        names = table.column_names
+    elif schema is not None:
+        names = [name for name in schema.names if name in table.column_names]
+    else:
+        names = [name for name in table.column_names if name != "year"]
+    fields = [
+        (
+            schema.field(name)
+            if schema is not None and name in schema.names
+            else table.schema.field(name)
+        )
+        for name in names
+    ]
+    metadata = (schema if schema is not None else table.schema).metadata
+    return table.select(names).cast(pa.schema(fields, metadata=metadata))
+
+
+def load_parquet(
+    path,
+    columns=None,
+    date_col=None,
+    start_date=None,
+    end_date=None,
+    id_col=None,
+    ids=None,
+    filters=None,
+    library="pandas",
+):
+    """Read only the needed slice of a parquet file or dataset.
+
+    The file is memory-mapped, only `columns` are read, and the row filters
+    are pushed down to the reader, so that row groups (or, for a
+    partitioned dataset directory, whole partitions) whose statistics rule
+    them out are skipped.
+
+    Parameters
+    ----------
+    path : str or Path
+        A parquet file, or a directory holding a Hive-partitioned dataset,
+        such as one written by `write_partitioned_parquet`. A dataset is
+        read with the columns of the frame that was written: a derived
+        "year" partition key is dropped, and the other partition keys get
+        back their position and type if the dataset has a `_common_metadata`
+        file.
+    columns : list, optional
+        Columns to read. A pandas index stored in the file is always read.
+    date_col : str, optional
+        Column that `start_date` and `end_date` (inclusive) apply to.
+    id_col : str, optional
+        Column whose value must be one of `ids`, e.g. "permno".
+    filters : list or pyarrow.compute.Expression, optional
+        Additional filters, in any form accepted by `pyarrow.parquet.read_table`.
+    library : str
+        "pandas" for a pandas DataFrame, "polars" for a polars DataFrame or
+        "arrow" for a pyarrow Table.
+    """
+    if library not in ["pandas", "polars", "arrow"]:
+        raise ValueError("Unknown library")
+
+    # For a dataset written by `write_partitioned_parquet`, also bound the
+    # year partition key so that only the matching partitions are scanned
+    partitioning = "hive"
+    year_col = None
+    schema = None
+    if Path(path).is_dir():
+        partitioning = ds.HivePartitioning.discover(infer_dictionary=False)
+        if next(Path(path).glob("year=*"), None) is not None:
+            year_col = "year"
+        if (Path(path) / "_common_metadata").exists():
+            schema = pq.read_schema(Path(path) / "_common_metadata")
+
+    expression = _parquet_filter(
+        date_col, start_date, end_date, id_col, ids, filters, year_col=year_col
+    )
+    table = pq.read_table(
+        path,
+        columns=columns,
+        filters=expression,
+        partitioning=partitioning,
+        memory_map=True,
+        use_pandas_metadata=True,
+    )
+    if year_col is not None or schema is not None:
+        table = _restore_dataset_columns(table, columns, schema)
+    if library == "pandas":
+        return table.to_pandas()
+    elif library == "polars":
+        return pl.from_arrow(table)
+    return table
+
+
+def write_partitioned_parquet(
+    df, path, date_col, partition_cols=["year"], sort_by=[], row_group_size=100_000
+):
+    """Write `df` as a Hive-partitioned parquet dataset in the directory `path`.
+
+    A "year" partition key, if requested and not already a column, is
+    derived from `date_col`. Within each partition the rows are sorted by
+    `date_col` and then `sort_by`, and written in row groups of at most
+    `row_group_size` rows with column statistics, so that `load_parquet`
+    can skip whole partitions and row groups. Partitions present in `df`
+    replace those already in `path`; other partitions are left as is. A
+    single parquet file at `path` is replaced by the dataset.
+
+    The partition keys are not stored in the data files, so the schema of
+    `df` is written to `_common_metadata`, from which `load_parquet`
+    restores the original columns.
+
+    Examples
+    --------
+
+    ```
+    write_partitioned_parquet(
+        df_msf, DATA_DIR / "CRSP_MSF_INDEX_INPUTS.parquet",
+        date_col="date", partition_cols=["year", "exchcd"], sort_by=["permno"]
+    )
+    ```
+    """
+    path = Path(path)
+    # Kept in _common_metadata, so that load_parquet can restore the columns
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    if "year" in partition_cols and "year" not in df.columns:
+        df = df.assign(year=df[date_col].dt.year)
+    df = df.sort_values(list(partition_cols) + [date_col] + list(sort_by))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    # A single file written with partitioning turned off is replaced once
+    # the dataset has been written next to it
+    replaces_file = path.is_file()
+    target = path.with_name(f".{path.name}.partitioned") if replaces_file else path
+    ds.write_dataset(
+        table,
+        target,
+        format="parquet",
+        partitioning=list(partition_cols),
+        partitioning_flavor="hive",
+        existing_data_behavior="delete_matching",
+        min_rows_per_group=min(row_group_size, 10_000),
+        max_rows_per_group=row_group_size,
+        basename_template="part-{i}.parquet",
+    )
+    pq.write_metadata(schema, target / "_common_metadata")
+    if replaces_file:
+        path.unlink()
+        target.rename(path)
+
+
+def stream_sql_to_parquet(
+    query,
+    con,
+    path,
+    chunksize=500_000,
+    date_cols=None,
+    column_types=None,
+    transform=None,
+):
+    """Stream the result of a SQL `query` into a parquet file at `path`.
+
+    Rows are fetched `chunksize` at a time, each chunk is optionally passed
+    through `transform` (which must work row by row), converted to Arrow and
+    appended to the file as a row group, so memory use stays bounded by the
+    chunk size. If `con` is a SQLAlchemy connection (such as the
+    `connection` attribute of a `wrds.Connection`), results are streamed
+    with a server-side cursor. A DBAPI connection such as `sqlite3` also
+    works, using its `fetchmany`.
+
+    The schema of the file is that of the first chunk, with the pyarrow
+    types in `column_types` (a dict keyed by column name) taking precedence,
+    and every chunk is cast to it. Use `column_types` for columns that may
+    be entirely missing in the first chunk, since their type cannot be
+    inferred from it.
+
+    Returns the number of rows written.
+    """
+    if hasattr(con, "execution_options"):
+        con = con.execution_options(stream_results=True, max_row_buffer=chunksize)
+    chunks = pd.read_sql_query(query, con, chunksize=chunksize, parse_dates=date_cols)
+
+    writer = None
+    n_rows = 0
+    try:
+        for chunk in chunks:
+            if transform is not None:
+                chunk = transform(chunk)
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                for name, type_ in (column_types or {}).items():
+                    i = schema.get_field_index(name)
+                    schema = schema.set(i, pa.field(name, type_))
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(table.cast(writer.schema))
+            n_rows += len(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
+
+
+class ConnectionPool:
+    """A small pool of database connections, shared across a pull session.
+
+    Connections are opened lazily with `connect()`, only when a query needs
+    one, and at most `max_size` are open at a time. A connection is returned
+    to the pool after use, and checked with `health_check` (a SQL query)
+    before it is handed out again; broken connections, and any connection
+    in use when an exception is raised, are closed and replaced. `connect`
+    can return a `wrds.Connection`, a SQLAlchemy connection or a DBAPI
+    connection such as `sqlite3`.
+
+    Examples
+    --------
+
+    ```
+    with ConnectionPool(lambda: wrds.Connection(wrds_username=WRDS_USERNAME)) as pool:
+        comp = pull_compustat(pool=pool)
+        ccm = pull_CRSP_Comp_Link_Table(pool=pool)
+    ```
+    """
+
+    def __init__(self, connect, max_size=4, health_check="SELECT 1"):
+        self.connect = connect
+        self.max_size = max_size
+        self.health_check = health_check
+        self._idle = []
+        self._n_open = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a `with` block."""
+        con = self._acquire()
+        try:
+            yield con
+        except BaseException:
+            self._discard(con)
+            raise
+        with self._condition:
+            if not self._closed:
+                self._idle.append(con)
+                self._condition.notify()
+                return
+        self._discard(con)
+
+    def close(self):
+        """Close the idle connections. Borrowed ones are closed when returned."""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for con in idle:
+            self._discard(con)
+
+    def _acquire(self):
+        while True:
+            with self._condition:
+                while not self._idle and self._n_open >= self.max_size:
+                    self._condition.wait()
+                if not self._idle:
+                    self._n_open += 1
+                    break
+                con = self._idle.pop()
+            if self._is_healthy(con):
+                return con
+            self._discard(con)
+
+        try:
+            return self.connect()
+        except BaseException:
+            with self._condition:
+                self._n_open -= 1
+                self._condition.notify()
+            raise
+
+    def _is_healthy(self, con):
+        if self.health_check is None:
+            return True
+        try:
+            pd.read_sql_query(self.health_check, _sql_connection(con))
+        except Exception:
+            return False
+        return True
+
+    def _discard(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
+        with self._condition:
+            self._n_open -= 1
+            self._condition.notify()
+
+
+@contextmanager
+def borrow_connection(connect, pool=None):
+    """Borrow a connection from `pool` if one is given. Otherwise open one
+    with `connect()` and close it afterwards.
+    """
+    if pool is not None:
+        with pool.connection() as con:
+            yield con
+    else:
+        con = connect()
+        try:
+            yield con
+        finally:
+            con.close()
+
+
+def _year_shards(start_date, end_date):
+    start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    shards = []
+    for year in range(start_date.year, end_date.year + 1):
+        start = max(start_date, pd.Timestamp(year=year, month=1, day=1))
+        end = min(end_date, pd.Timestamp(year=year, month=12, day=31))
+        shards.append((f"year={year}", start, end))
+    return shards
+
+
+def _sql_connection(con):
+    # A wrds.Connection wraps the SQLAlchemy connection that pandas reads from
+    return con.connection if hasattr(con, "raw_sql") else con
+
+
+def _write_common_metadata(path, schema, frame):
+    """Write the schema of the pulled `frame` to `<path>/_common_metadata`.
+
+    `schema` is that of the data files. A "year" column of `frame`, which
+    the files only hold as the partition key, is put back in its position,
+    so that `load_parquet` returns it.
+    """
+    if "year" in frame.columns:
+        year = pa.Schema.from_pandas(frame[["year"]], preserve_index=False)
+        position = list(frame.columns).index("year")
+        schema = schema.insert(position, year.field("year"))
+    pq.write_metadata(schema, path / "_common_metadata")
+
+
+def pull_sharded_to_parquet(
+    make_query,
+    connect,
+    path,
+    start_date,
+    end_date,
+    date_cols=None,
+    column_types=None,
+    transform=None,
+    max_workers=4,
+    retries=2,
+    backoff=1.0,
+    chunksize=500_000,
+):
+    """Run a large date-bounded query one calendar year at a time, in parallel.
+
+    `make_query(start_date, end_date)` must return the SQL for one shard,
+    given "YYYY-MM-DD" strings. The shards run concurrently on
+    `max_workers` threads, drawing connections from `connect`, either a
+    `ConnectionPool` or a function opening a connection (in which case a
+    pool of `max_workers` connections is used for this call only). Each shard is streamed with
+    `stream_sql_to_parquet` into its own partition file,
+    `<path>/year=YYYY/part-0.parquet`, so that `load_parquet` reads the
+    directory as one dataset and prunes it by year. A "year" column in the
+    result is only kept as the partition key; the schema recorded in
+    `<path>/_common_metadata` lets `load_parquet` return it in place.
+
+    A failed shard is retried up to `retries` times on a fresh connection,
+    waiting `backoff` seconds, doubled after each attempt. Completed shards
+    are recorded in `<path>/_manifest.json` as they finish, and are skipped
+    on a later call with the same shard dates, so an interrupted or partly
+    failed pull resumes where it stopped. If shards still fail, the others
+    are completed and then a RuntimeError is raised. A shard pulled again
+    with no rows never keeps the rows of its earlier partition file: the
+    file is replaced by an empty one with the schema of the query or, if
+    the query returned no result chunks at all, removed.
+
+    Returns the manifest, a dict keyed by shard ("year=YYYY").
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    manifest_path = path / "_manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    shards = []
+    for label, start, end in _year_shards(start_date, end_date):
+        start, end = start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+        entry = manifest.get(label, {})
+        if entry.get("start_date") != start or entry.get("end_date") != end:
+            shards.append((label, start, end))
+
+    pulled = {}
+
+    def shard_transform(chunk):
+        if transform is not None:
+            chunk = transform(chunk)
+        pulled.setdefault("frame", chunk.head(0))
+        return chunk.drop(columns="year", errors="ignore")
+
+    lock = threading.Lock()
+    if isinstance(connect, ConnectionPool):
+        pool, own_pool = connect, False
+    else:
+        pool, own_pool = ConnectionPool(connect, max_size=max_workers), True
+
+    def pull_shard(label, start, end):
+        shard_dir = path / label
+        shard_dir.mkdir(exist_ok=True)
+        # Hidden until complete, so that readers never see a partial shard
+        tmp_path = shard_dir / ".part-0.parquet"
+        for attempt in range(retries + 1):
+            try:
+                # A connection that raised is discarded by the pool
+                with pool.connection() as con:
+                    n_rows = stream_sql_to_parquet(
+                        make_query(start, end),
+                        _sql_connection(con),
+                        tmp_path,
+                        chunksize=chunksize,
+                        date_cols=date_cols,
+                        column_types=column_types,
+                        transform=shard_transform,
+                    )
+                break
+            except Exception:
+                if attempt == retries:
+                    raise
+                time.sleep(backoff * 2**attempt)
+        if tmp_path.exists():
+            tmp_path.replace(shard_dir / "part-0.parquet")
+        else:
+            # Nothing was written, so a file from an earlier pull is stale
+            (shard_dir / "part-0.parquet").unlink(missing_ok=True)
+
+        with lock:
+            manifest[label] = {
+                "start_date": start,
+                "end_date": end,
+                "rows": n_rows,
+                "completed_at": pd.Timestamp.now().isoformat(),
+            }
+            tmp_manifest = manifest_path.with_suffix(".json.tmp")
+            tmp_manifest.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+            tmp_manifest.replace(manifest_path)
+
+    failed = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(pull_shard, *shard): shard[0] for shard in shards
+            }
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    failed[futures[future]] = future.exception()
+    finally:
+        if own_pool:
+            pool.close()
+
+    completed_file = next(path.glob("year=*/part-0.parquet"), None)
+    if "frame" in pulled and completed_file is not None:
+        _write_common_metadata(path, pq.read_schema(completed_file), pulled["frame"])
+
+    if failed:
+        labels = ", ".join(sorted(failed))
+        raise RuntimeError(
+            f"{len(failed)} shard(s) failed: {labels}. "
+            "Completed shards are recorded in the manifest; call again to resume."
+        ) from next(iter(failed.values()))
+    return manifest
+
+
+def sharded_pull_complete(path, start_date="1959-01-01"):
+    """Return whether `pull_sharded_to_parquet` has completed a store at `path`.
+
+    The store is complete if its manifest records every year from that of
+    `start_date` through the latest year pulled. A missing or partly
+    failed pull returns False, and should be finished by calling
+    `pull_sharded_to_parquet` again, which resumes it. A complete store can
+    be kept up to date with `refresh_partitioned_parquet`, which also pulls
+    any years after the latest one recorded.
+    """
+    manifest_path = Path(path) / "_manifest.json"
+    if not manifest_path.exists():
+        return False
+    manifest = json.loads(manifest_path.read_text())
+    years = {int(label.removeprefix("year=")) for label in manifest}
+    if not years:
+        return False
+    return years >= set(range(pd.Timestamp(start_date).year, max(years) + 1))
+
+
+def refresh_partitioned_parquet(
+    make_query,
+    connect,
+    path,
+    date_col,
+    key_cols,
+    lookback,
+    start_date="1959-01-01",
+    end_date=None,
+    date_cols=None,
+    column_types=None,
+    transform=None,
+):
+    """Incrementally refresh a year-partitioned parquet store.
+
+    The store is a directory of `year=YYYY` partitions, as written by
+    `pull_sharded_to_parquet` or `write_partitioned_parquet` with
+    partition_cols=["year"]. Its high-water mark is the largest `date_col`
+    already stored. Only rows dated from the high-water mark minus
+    `lookback` (a DateOffset or Timedelta, to pick up restatements) through
+    `end_date` are pulled with `make_query(start_date, end_date)`, and they
+    are upserted by `key_cols`: stored rows with the same key are replaced
+    and new keys are added. Only the partitions for the years pulled are
+    rewritten, each one replaced in a single rename. An empty store is
+    filled from `start_date`.
+
+    `connect` is a `ConnectionPool` or a function opening a connection, and
+    `date_cols`, `column_types` and `transform` are as in
+    `stream_sql_to_parquet`.
+
+    Returns a dict with the previous high-water mark, the start date of the
+    pull, and the number of rows pulled.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    if next(path.glob("year=*/*=*"), None) is not None:
+        raise ValueError("Only stores partitioned by year alone can be refreshed")
+    end_date = pd.Timestamp.today() if end_date is None else pd.Timestamp(end_date)
+
+    high_water_mark = None
+    if next(path.glob("year=*/*.parquet"), None) is not None:
+        dates = load_parquet(path, columns=[date_col], library="arrow")[date_col]
+        high_water_mark = pc.max(dates).as_py()
+    if high_water_mark is None:
+        pull_start = pd.Timestamp(start_date)
+    else:
+        pull_start = pd.Timestamp(high_water_mark) - lookback
+
+    query = make_query(pull_start.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
+    if isinstance(connect, ConnectionPool):
+        connection = connect.connection()
+    else:
+        connection = borrow_connection(connect)
+    with connection as con:
+        new = pd.read_sql_query(query, _sql_connection(con), parse_dates=date_cols)
+    if transform is not None:
+        new = transform(new)
+    frame = new.head(0)
+    new = new.drop(columns="year", errors="ignore")
+
+    for year, new_rows in new.groupby(new[date_col].dt.year):
+        shard_dir = path / f"year={year}"
+        shard_dir.mkdir(exist_ok=True)
+        old_files = sorted(shard_dir.glob("*.parquet"))
+        rows = pd.concat([pd.read_parquet(file) for file in old_files] + [new_rows])
+        rows = rows.drop_duplicates(subset=key_cols, keep="last")
+        rows = rows.sort_values([date_col] + list(key_cols))
+
+        table = pa.Table.from_pandas(rows, preserve_index=False)
+        schema = table.schema
+        for name, type_ in (column_types or {}).items():
+            schema = schema.set(schema.get_field_index(name), pa.field(name, type_))
+        tmp_path = shard_dir / ".part-0.parquet"
+        pq.write_table(table.cast(schema), tmp_path)
+        tmp_path.replace(shard_dir / "part-0.parquet")
+        for file in old_files:
+            if file.name != "part-0.parquet":
+                file.unlink()
+    if len(new) > 0:
+        _write_common_metadata(path, schema, frame)
+
+    return {
+        "high_water_mark": high_water_mark,
+        "start_date": pull_start,
+        "rows": len(new),
+    }
+
+
+########################################################################################
+## Web Helpers
+########################################################################################
+
+
+def make_session(pool_size=8, retries=3, backoff_factor=0.5):
+    """Return a `requests.Session` with a connection pool of `pool_size`
+    and retries with exponential backoff on connection errors and on
+    429/5xx responses.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 if __name__ == "__main__":
     pass
@@ -26,13 +26,30 @@ https://wrds-www.wharton.upenn.edu/documents/400/CRSP_Programmers_Guide.pdf
 
 """
 
+import shutil
 from pathlib import Path
 
 import pandas as pd
-import wrds
+import pyarrow as pa
 from pandas.tseries.offsets import MonthEnd
 
+from misc_tools import (
+    ConnectionPool,
+    load_parquet,
+    pull_sharded_to_parquet,
+    refresh_partitioned_parquet,
+    sharded_pull_complete,
+    stream_sql_to_parquet,
+    write_partitioned_parquet,
+)
 from settings import config
+from wrds_helpers import (
+    PARTITION_CRSP,
+    PARTITION_CRSP_BY_EXCHANGE,
+    REFRESH_WRDS,
+    connect_to_wrds,
+    wrds_connection,
+)
 
 OUTPUT_DIR = Path(config("OUTPUT_DIR"))
 DATA_DIR = Path(config("DATA_DIR"))
@@ -64,33 +81,123 @@ description_compustat = {
 }
 
 
-def pull_compustat(wrds_username=WRDS_USERNAME):
+def _compustat_query(start_date="1959-01-01", end_date="9999-12-31"):
+    query = f"""
+    SELECT 
+        gvkey, datadate, at, sale, cogs, xsga, xint, pstkl, txditc,
+        pstkrv, seq, pstk, ni, sich, dp, ebit
+    FROM 
+        comp.funda
+    WHERE 
+        indfmt='INDL' AND -- industrial companies
+        datafmt='STD' AND -- only standardized records
+        popsrc='D' AND -- only from primary sources
+        consol='C' AND -- consolidated financial statements
+        datadate BETWEEN '{start_date}' AND '{end_date}'
+    """
+    return query
+
+
+COMPUSTAT_QUERY = _compustat_query()
+
+COMPUSTAT_COLUMN_TYPES = {
+    col: pa.float64()
+    for col in "at sale cogs xsga xint pstkl txditc pstkrv seq pstk ni sich dp ebit".split()
+}
+
+
+def _clean_compustat(comp):
+    comp["year"] = comp["datadate"].dt.year
+    return comp
+
+
+def pull_compustat(wrds_username=WRDS_USERNAME, pool=None):
     """
     See description_compustat for a description of the variables.
     """
-    sql_query = """
-        SELECT 
-            gvkey, datadate, at, sale, cogs, xsga, xint, pstkl, txditc,
-            pstkrv, seq, pstk, ni, sich, dp, ebit
-        FROM 
-            comp.funda
-        WHERE 
-            indfmt='INDL' AND -- industrial companies
-            datafmt='STD' AND -- only standardized records
-            popsrc='D' AND -- only from primary sources
-            consol='C' AND -- consolidated financial statements
-            datadate >= '01/01/1959'
-        """
     # with wrds.Connection(wrds_username=wrds_username) as db:
-    #     comp = db.raw_sql(sql_query, date_cols=["datadate"])
-    db = wrds.Connection(wrds_username=wrds_username)
-    comp = db.raw_sql(sql_query, date_cols=["datadate"])
-    db.close()
+    #     comp = db.raw_sql(COMPUSTAT_QUERY, date_cols=["datadate"])
+    with wrds_connection(wrds_username, pool) as db:
+        comp = db.raw_sql(COMPUSTAT_QUERY, date_cols=["datadate"])
 
-    comp["year"] = comp["datadate"].dt.year
+    comp = _clean_compustat(comp)
     return comp
 
 
+def stream_compustat(path, wrds_username=WRDS_USERNAME, chunksize=500_000, pool=None):
+    """
+    Same as `pull_compustat`, but streams the result to a parquet file at
+    `path` in chunks of `chunksize` rows with a server-side cursor, so that
+    the full result set is never held in memory.
+    """
+    with wrds_connection(wrds_username, pool) as db:
+        n_rows = stream_sql_to_parquet(
+            COMPUSTAT_QUERY,
+            db.connection,
+            path,
+            chunksize=chunksize,
+            date_cols=["datadate"],
+            column_types=COMPUSTAT_COLUMN_TYPES,
+            transform=_clean_compustat,
+        )
+    return n_rows
+
+
+def pull_compustat_sharded(
+    path,
+    start_date="1959-01-01",
+    end_date=None,
+    wrds_username=WRDS_USERNAME,
+    max_workers=4,
+    pool=None,
+):
+    """
+    Same as `stream_compustat`, but split into one query per year of
+    `datadate`, run concurrently on up to `max_workers` WRDS connections and
+    written to `<path>/year=YYYY/`. Rerunning resumes from the shards
+    recorded as complete. See `misc_tools.pull_sharded_to_parquet`.
+    """
+    end_date = pd.Timestamp.today() if end_date is None else end_date
+    manifest = pull_sharded_to_parquet(
+        _compustat_query,
+        pool if pool is not None else connect_to_wrds(wrds_username),
+        path,
+        start_date,
+        end_date,
+        date_cols=["datadate"],
+        column_types=COMPUSTAT_COLUMN_TYPES,
+        transform=_clean_compustat,
+        max_workers=max_workers,
+    )
+    return manifest
+
+
+def refresh_compustat(
+    path,
+    lookback=pd.DateOffset(years=2),
+    wrds_username=WRDS_USERNAME,
+    pool=None,
+):
+    """
+    Bring a year-partitioned Compustat store (see `pull_compustat_sharded`)
+    up to date. Only records with `datadate` after the latest one stored,
+    less `lookback` to pick up restatements, are pulled, and they are
+    upserted by gvkey and datadate. See `misc_tools.refresh_partitioned_parquet`.
+    """
+    summary = refresh_partitioned_parquet(
+        _compustat_query,
+        pool if pool is not None else connect_to_wrds(wrds_username),
+        path,
+        date_col="datadate",
+        key_cols=["gvkey", "datadate"],
+        lookback=lookback,
+        date_cols=["datadate"],
+        column_types=COMPUSTAT_COLUMN_TYPES,
+        transform=_clean_compustat,
+    )
+    return summary
+
+
 description_crsp = {
     "permno": "Permanent Number - A unique identifier assigned by CRSP to each security.",
     "permco": "Permanent Company - A unique company identifier assigned by CRSP that remains constant over time for a given company.",
@@ -109,7 +216,7 @@ description_crsp = {
     "mthprc": "Monthly Price - The price of the security at the end of the month.",
 }
 
-def get_crsp_columns(wrds_username=WRDS_USERNAME):
+def get_crsp_columns(wrds_username=WRDS_USERNAME, pool=None):
     """Get all column names from CRSP monthly stock file (CIZ format)."""
     sql_query = """
         SELECT column_name, data_type
@@ -119,13 +226,50 @@ def get_crsp_columns(wrds_username=WRDS_USERNAME):
         ORDER BY ordinal_position;
     """
     
-    db = wrds.Connection(wrds_username=wrds_username)
-    columns = db.raw_sql(sql_query)
-    db.close()
+    with wrds_connection(wrds_username, pool) as db:
+        columns = db.raw_sql(sql_query)
     
     return columns
 
-def pull_CRSP_stock_ciz(wrds_username=WRDS_USERNAME):
+def _CRSP_stock_ciz_query(start_date="1959-01-01", end_date="9999-12-31"):
+    query = f"""
+    SELECT 
+        permno, permco, mthcaldt, 
+        issuertype, securitytype, securitysubtype, sharetype, 
+        usincflg, 
+        primaryexch, conditionaltype, tradingstatusflg,
+        mthret, mthretx, shrout, mthprc,
+        cfacshr, cfacpr
+    FROM 
+        crsp.msf_v2
+    WHERE 
+        mthcaldt BETWEEN '{start_date}' AND '{end_date}'
+    """
+    return query
+
+
+CRSP_STOCK_CIZ_QUERY = _CRSP_stock_ciz_query()
+
+CRSP_STOCK_CIZ_COLUMN_TYPES = {
+    "mthret": pa.float64(),
+    "mthretx": pa.float64(),
+    "mthprc": pa.float64(),
+    "shrout": pa.float64(),
+    "cfacshr": pa.float64(),
+    "cfacpr": pa.float64(),
+}
+
+
+def _clean_CRSP_stock_ciz(crsp_m):
+    # change variable format to int
+    crsp_m[["permco", "permno"]] = crsp_m[["permco", "permno"]].astype(int)
+
+    # Line up date to be end of month
+    crsp_m["jdate"] = crsp_m["mthcaldt"] + MonthEnd(0)
+    return crsp_m
+
+
+def pull_CRSP_stock_ciz(wrds_username=WRDS_USERNAME, pool=None):
     """Pull necessary CRSP monthly stock data to
     compute Fama-French factors. Use the new CIZ format.
 
@@ -154,33 +298,87 @@ def pull_CRSP_stock_ciz(wrds_username=WRDS_USERNAME):
     market_cap = mthprc * shrout
 
     """
-    sql_query = """
-        SELECT 
-            permno, permco, mthcaldt, 
-            issuertype, securitytype, securitysubtype, sharetype, 
-            usincflg, 
-            primaryexch, conditionaltype, tradingstatusflg,
-            mthret, mthretx, shrout, mthprc,
-            cfacshr, cfacpr
-        FROM 
-            crsp.msf_v2
-        WHERE 
-            mthcaldt >= '01/01/1959'
-        """
-
-
+    with wrds_connection(wrds_username, pool) as db:
+        crsp_m = db.raw_sql(CRSP_STOCK_CIZ_QUERY, date_cols=["mthcaldt"])
 
-    db = wrds.Connection(wrds_username=wrds_username)
-    crsp_m = db.raw_sql(sql_query, date_cols=["mthcaldt"])
-    db.close()
-
-    # change variable format to int
-    crsp_m[["permco", "permno"]] = crsp_m[["permco", "permno"]].astype(int)
+    crsp_m = _clean_CRSP_stock_ciz(crsp_m)
+    return crsp_m
 
-    # Line up date to be end of month
-    crsp_m["jdate"] = crsp_m["mthcaldt"] + MonthEnd(0)
 
-    return crsp_m
+def stream_CRSP_stock_ciz(
+    path, wrds_username=WRDS_USERNAME, chunksize=500_000, pool=None
+):
+    """
+    Same as `pull_CRSP_stock_ciz`, but streams the result to a parquet file
+    at `path` in chunks of `chunksize` rows with a server-side cursor, so
+    that the full result set is never held in memory.
+    """
+    with wrds_connection(wrds_username, pool) as db:
+        n_rows = stream_sql_to_parquet(
+            CRSP_STOCK_CIZ_QUERY,
+            db.connection,
+            path,
+            chunksize=chunksize,
+            date_cols=["mthcaldt"],
+            column_types=CRSP_STOCK_CIZ_COLUMN_TYPES,
+            transform=_clean_CRSP_stock_ciz,
+        )
+    return n_rows
+
+
+def pull_CRSP_stock_ciz_sharded(
+    path,
+    start_date="1959-01-01",
+    end_date=None,
+    wrds_username=WRDS_USERNAME,
+    max_workers=4,
+    pool=None,
+):
+    """
+    Same as `stream_CRSP_stock_ciz`, but split into one query per year of
+    `mthcaldt`, run concurrently on up to `max_workers` WRDS connections and
+    written to `<path>/year=YYYY/`. Rerunning resumes from the shards
+    recorded as complete. See `misc_tools.pull_sharded_to_parquet`.
+    """
+    end_date = pd.Timestamp.today() if end_date is None else end_date
+    manifest = pull_sharded_to_parquet(
+        _CRSP_stock_ciz_query,
+        pool if pool is not None else connect_to_wrds(wrds_username),
+        path,
+        start_date,
+        end_date,
+        date_cols=["mthcaldt"],
+        column_types=CRSP_STOCK_CIZ_COLUMN_TYPES,
+        transform=_clean_CRSP_stock_ciz,
+        max_workers=max_workers,
+    )
+    return manifest
+
+
+def refresh_CRSP_stock_ciz(
+    path,
+    lookback=pd.DateOffset(months=3),
+    wrds_username=WRDS_USERNAME,
+    pool=None,
+):
+    """
+    Bring a year-partitioned CRSP CIZ store (see `pull_CRSP_stock_ciz_sharded`)
+    up to date. Only months after the latest `mthcaldt` stored, less
+    `lookback` to pick up corrections, are pulled, and they are upserted by
+    permno and mthcaldt. See `misc_tools.refresh_partitioned_parquet`.
+    """
+    summary = refresh_partitioned_parquet(
+        _CRSP_stock_ciz_query,
+        pool if pool is not None else connect_to_wrds(wrds_username),
+        path,
+        date_col="mthcaldt",
+        key_cols=["permno", "mthcaldt"],
+        lookback=lookback,
+        date_cols=["mthcaldt"],
+        column_types=CRSP_STOCK_CIZ_COLUMN_TYPES,
+        transform=_clean_CRSP_stock_ciz,
+    )
+    return summary
 
 
 description_crsp_comp_link = {
@@ -193,7 +391,7 @@ description_crsp_comp_link = {
 }
 
 
-def pull_CRSP_Comp_Link_Table(wrds_username=WRDS_USERNAME):
+def pull_CRSP_Comp_Link_Table(wrds_username=WRDS_USERNAME, pool=None):
     sql_query = """
         SELECT 
             gvkey, lpermno AS permno, linktype, linkprim, linkdt, linkenddt
@@ -203,16 +401,14 @@ def pull_CRSP_Comp_Link_Table(wrds_username=WRDS_USERNAME):
             substr(linktype,1,1)='L' AND 
             (linkprim ='C' OR linkprim='P')
         """
-    db = wrds.Connection(wrds_username=wrds_username)
-    ccm = db.raw_sql(sql_query, date_cols=["linkdt", "linkenddt"])
-    db.close()
+    with wrds_connection(wrds_username, pool) as db:
+        ccm = db.raw_sql(sql_query, date_cols=["linkdt", "linkenddt"])
     return ccm
 
 
-def pull_Fama_French_factors(wrds_username=WRDS_USERNAME):
-    conn = wrds.Connection(wrds_username=wrds_username)
-    ff = conn.get_table(library="ff", table="factors_monthly")
-    conn.close()
+def pull_Fama_French_factors(wrds_username=WRDS_USERNAME, pool=None):
+    with wrds_connection(wrds_username, pool) as conn:
+        ff = conn.get_table(library="ff", table="factors_monthly")
     ff[["smb", "hml"]] = ff[["smb", "hml"]].astype(float)
 
     ff["date"] = pd.to_datetime(ff["date"])
@@ -221,30 +417,114 @@ def pull_Fama_French_factors(wrds_username=WRDS_USERNAME):
     return ff
 
 
-def load_compustat(data_dir=DATA_DIR):
+def load_compustat(
+    data_dir=DATA_DIR,
+    columns=None,
+    start_date=None,
+    end_date=None,
+    gvkeys=None,
+    filters=None,
+    library="pandas",
+):
+    """Load Compustat, reading only `columns` and the rows with `datadate`
+    between `start_date` and `end_date` and `gvkey` in `gvkeys`.
+    See `misc_tools.load_parquet`.
+    """
     path = Path(data_dir) / "Compustat.parquet"
-    comp = pd.read_parquet(path)
+    comp = load_parquet(
+        path,
+        columns=columns,
+        date_col="datadate",
+        start_date=start_date,
+        end_date=end_date,
+        id_col="gvkey",
+        ids=gvkeys,
+        filters=filters,
+        library=library,
+    )
     return comp
 
 
-def load_CRSP_stock_ciz(data_dir=DATA_DIR):
+def load_CRSP_stock_ciz(
+    data_dir=DATA_DIR,
+    columns=None,
+    start_date=None,
+    end_date=None,
+    permnos=None,
+    filters=None,
+    library="pandas",
+):
+    """Load the CRSP monthly stock file (CIZ), reading only `columns` and
+    the rows with `mthcaldt` between `start_date` and `end_date` and
+    `permno` in `permnos`. See `misc_tools.load_parquet`.
+    """
     path = Path(data_dir) / "CRSP_stock_ciz.parquet"
-    crsp = pd.read_parquet(path)
+    crsp = load_parquet(
+        path,
+        columns=columns,
+        date_col="mthcaldt",
+        start_date=start_date,
+        end_date=end_date,
+        id_col="permno",
+        ids=permnos,
+        filters=filters,
+        library=library,
+    )
     return crsp
 
 
-def load_CRSP_Comp_Link_Table(data_dir=DATA_DIR):
+def load_CRSP_Comp_Link_Table(
+    data_dir=DATA_DIR, columns=None, permnos=None, filters=None, library="pandas"
+):
     path = Path(data_dir) / "CRSP_Comp_Link_Table.parquet"
-    ccm = pd.read_parquet(path)
+    ccm = load_parquet(
+        path,
+        columns=columns,
+        id_col="permno",
+        ids=permnos,
+        filters=filters,
+        library=library,
+    )
     return ccm
 
 
-def load_Fama_French_factors(data_dir=DATA_DIR):
+def load_Fama_French_factors(
+    data_dir=DATA_DIR,
+    columns=None,
+    start_date=None,
+    end_date=None,
+    filters=None,
+    library="pandas",
+):
     path = Path(data_dir) / "FF_FACTORS.parquet"
-    ff = pd.read_parquet(path)
+    ff = load_parquet(
+        path,
+        columns=columns,
+        date_col="date",
+        start_date=start_date,
+        end_date=end_date,
+        filters=filters,
+        library=library,
+    )
     return ff
 
 
+def _pull_or_refresh(path, pull, refresh, pool=None):
+    """Write the year-partitioned store at `path` with `pull` until it is
+    complete, and from then on update it with `refresh`. A single file or a
+    store not written by `pull`, such as those written without REFRESH_WRDS,
+    is replaced.
+    """
+    if sharded_pull_complete(path):
+        return refresh(path, pool=pool)
+    if path.is_file():
+        path.unlink()
+    elif path.is_dir() and not (path / "_manifest.json").exists():
+        shutil.rmtree(path)
+    # Opens its own connections, to pull several years at a time
+    return pull(path)
+
+
 def _demo():
     comp = load_compustat(data_dir=DATA_DIR)
     crsp = load_CRSP_stock_ciz(data_dir=DATA_DIR)
@@ -253,14 +533,42 @@ def _demo():
 
 
 if __name__ == "__main__":
-    comp = pull_compustat(wrds_username=WRDS_USERNAME)
-    comp.to_parquet(DATA_DIR / "Compustat.parquet")
-
-    crsp = pull_CRSP_stock_ciz(wrds_username=WRDS_USERNAME)
-    crsp.to_parquet(DATA_DIR / "CRSP_stock_ciz.parquet")
-
-    ccm = pull_CRSP_Comp_Link_Table(wrds_username=WRDS_USERNAME)
-    ccm.to_parquet(DATA_DIR / "CRSP_Comp_Link_Table.parquet")
-
-    ff = pull_Fama_French_factors(wrds_username=WRDS_USERNAME)
-    ff.to_parquet(DATA_DIR / "FF_FACTORS.parquet")
+    # One lazily opened connection, shared by all of the pulls below except
+    # the initial sharded pulls
+    with ConnectionPool(connect_to_wrds(WRDS_USERNAME), max_size=1) as pool:
+        if REFRESH_WRDS:
+            _pull_or_refresh(
+                DATA_DIR / "Compustat.parquet",
+                pull_compustat_sharded,
+                refresh_compustat,
+                pool=pool,
+            )
+            _pull_or_refresh(
+                DATA_DIR / "CRSP_stock_ciz.parquet",
+                pull_CRSP_stock_ciz_sharded,
+                refresh_CRSP_stock_ciz,
+                pool=pool,
+            )
+        else:
+            stream_compustat(DATA_DIR / "Compustat.parquet", pool=pool)
+
+            if PARTITION_CRSP:
+                crsp = pull_CRSP_stock_ciz(pool=pool)
+                partition_cols = ["year"]
+                if PARTITION_CRSP_BY_EXCHANGE:
+                    partition_cols.append("primaryexch")
+                write_partitioned_parquet(
+                    crsp,
+                    DATA_DIR / "CRSP_stock_ciz.parquet",
+                    date_col="mthcaldt",
+                    partition_cols=partition_cols,
+                    sort_by=["permno"],
+                )
+            else:
+                stream_CRSP_stock_ciz(DATA_DIR / "CRSP_stock_ciz.parquet", pool=pool)
+
+        ccm = pull_CRSP_Comp_Link_Table(pool=pool)
+        ccm.to_parquet(DATA_DIR / "CRSP_Comp_Link_Table.parquet")
+
+        ff = pull_Fama_French_factors(pool=pool)
+        ff.to_parquet(DATA_DIR / "FF_FACTORS.parquet")
@@ -23,9 +23,23 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import wrds
-
+import pyarrow as pa
+
+from delisting_returns import apply_delisting_returns
+from misc_tools import (
+    ConnectionPool,
+    load_parquet,
+    pull_sharded_to_parquet,
+    stream_sql_to_parquet,
+    write_partitioned_parquet,
+)
 from settings import config
+from wrds_helpers import (
+    PARTITION_CRSP,
+    PARTITION_CRSP_BY_EXCHANGE,
+    connect_to_wrds,
+    wrds_connection,
+)
 
 DATA_DIR = Path(config("DATA_DIR"))
 WRDS_USERNAME = config("WRDS_USERNAME")
@@ -33,24 +47,17 @@ START_DATE = config("START_DATE")
 END_DATE = config("END_DATE")
 
 
-def pull_CRSP_monthly_file(
-    start_date=START_DATE, end_date=END_DATE, wrds_username=WRDS_USERNAME
-):
-    """
-    Pulls monthly CRSP stock data from a specified start date to end date.
-
-    SQL query to pull data, controls for delisting, and importantly
-    follows the guidelines that CRSP uses for inclusion, with the exception
-    of code 73, which is foreign companies -- without including this, the universe
-    of securities is roughly half of what it should be.
-    """
+def _extra_month(start_date):
     # Convert start_date to datetime if it's a string
     if isinstance(start_date, str):
         start_date = datetime.strptime(start_date, "%Y-%m-%d")
     # Not a perfect solution, but since value requires t-1 period market cap,
     # we need to pull one extra month of data. This is hidden from the user.
     start_date = start_date - relativedelta(months=1)
-    start_date = start_date.strftime("%Y-%m-%d")
+    return start_date.strftime("%Y-%m-%d")
+
+
+def _CRSP_monthly_file_query(start_date=START_DATE, end_date=END_DATE):
 
     query = f"""
     SELECT 
@@ -76,16 +83,21 @@ def pull_CRSP_monthly_file(
         msf.date BETWEEN '{start_date}' AND '{end_date}' AND 
         msenames.shrcd IN (10, 11, 20, 21, 40, 41, 70, 71, 73)
     """
-    # with wrds.Connection(wrds_username=wrds_username) as db:
-    #     df = db.raw_sql(
-    #         query, date_cols=["date", "namedt", "nameendt", "dlstdt"]
-    #     )
-    db = wrds.Connection(wrds_username=wrds_username)
-    df = db.raw_sql(
-        query, date_cols=["date", "namedt", "nameendt", "dlstdt"]
-    )
-    db.close()
+    return query
+
+
+CRSP_MONTHLY_FILE_COLUMN_TYPES = {
+    "shrcls": pa.string(),
+    "naics": pa.string(),
+    "dlret": pa.float64(),
+    "dlretx": pa.float64(),
+    "dlstcd": pa.float64(),
+    "altprc": pa.float64(),
+    "vol": pa.float64(),
+}
+
 
+def _clean_CRSP_monthly_file(df):
     df = df.loc[:, ~df.columns.duplicated()]
     df["shrout"] = df["shrout"] * 1000
 
@@ -107,45 +119,84 @@ def pull_CRSP_monthly_file(
     return df
 
 
-def apply_delisting_returns(df):
-    """
-    Use instructions for handling delisting returns from: Chapter 7 of 
-    Bali, Engle, Murray --
-    Empirical asset pricing-the cross section of stock returns (2016)
-    
-    First change dlret column. 
-    If dlret is NA and dlstcd is not NA, then:
-    if dlstcd is 500, 520, 551-574, 580, or 584, then dlret = -0.3
-    if dlret is NA but dlstcd is not one of the above, then dlret = -1
+def pull_CRSP_monthly_file(
+    start_date=START_DATE, end_date=END_DATE, wrds_username=WRDS_USERNAME, pool=None
+):
     """
-    df["dlret"] = np.select(
-        [
-            df["dlstcd"].isin([500, 520, 580, 584] + list(range(551, 575)))
-            & df["dlret"].isna(),
-            df["dlret"].isna() & df["dlstcd"].notna() & df["dlstcd"] >= 200,
-            True,
-        ],
-        [-0.3, -1, df["dlret"]],
-        default=df["dlret"],
-    )
+    Pulls monthly CRSP stock data from a specified start date to end date.
 
-    df["dlretx"] = np.select(
-        [
-            df["dlstcd"].isin([500, 520, 580, 584] + list(range(551, 575)))
-            & df["dlretx"].isna(),
-            df["dlretx"].isna() & df["dlstcd"].notna() & df["dlstcd"] >= 200,
-            True,
-        ],
-        [-0.3, -1, df["dlretx"]],
-        default=df["dlretx"],
-    )
+    SQL query to pull data, controls for delisting, and importantly
+    follows the guidelines that CRSP uses for inclusion, with the exception
+    of code 73, which is foreign companies -- without including this, the universe
+    of securities is roughly half of what it should be.
+    """
+    query = _CRSP_monthly_file_query(_extra_month(start_date), end_date)
+    # with wrds.Connection(wrds_username=wrds_username) as db:
+    #     df = db.raw_sql(
+    #         query, date_cols=["date", "namedt", "nameendt", "dlstdt"]
+    #     )
+    with wrds_connection(wrds_username, pool) as db:
+        df = db.raw_sql(query, date_cols=["date", "namedt", "nameendt", "dlstdt"])
 
-    # Replace the inplace operations with direct assignments
-    df["ret"] = df["ret"].fillna(df["dlret"])
-    df["retx"] = df["retx"].fillna(df["dlretx"])
+    df = _clean_CRSP_monthly_file(df)
     return df
 
 
+def stream_CRSP_monthly_file(
+    path,
+    start_date=START_DATE,
+    end_date=END_DATE,
+    wrds_username=WRDS_USERNAME,
+    chunksize=500_000,
+    pool=None,
+):
+    """
+    Same as `pull_CRSP_monthly_file`, but streams the result to a parquet
+    file at `path` in chunks of `chunksize` rows with a server-side cursor,
+    so that the full result set is never held in memory.
+    """
+    query = _CRSP_monthly_file_query(_extra_month(start_date), end_date)
+    with wrds_connection(wrds_username, pool) as db:
+        n_rows = stream_sql_to_parquet(
+            query,
+            db.connection,
+            path,
+            chunksize=chunksize,
+            date_cols=["date", "namedt", "nameendt", "dlstdt"],
+            column_types=CRSP_MONTHLY_FILE_COLUMN_TYPES,
+            transform=_clean_CRSP_monthly_file,
+        )
+    return n_rows
+
+
+def pull_CRSP_monthly_file_sharded(
+    path,
+    start_date=START_DATE,
+    end_date=END_DATE,
+    wrds_username=WRDS_USERNAME,
+    max_workers=4,
+    pool=None,
+):
+    """
+    Same as `stream_CRSP_monthly_file`, but split into one query per year,
+    run concurrently on up to `max_workers` WRDS connections and written to
+    `<path>/year=YYYY/`. Rerunning resumes from the shards recorded as
+    complete. See `misc_tools.pull_sharded_to_parquet`.
+    """
+    manifest = pull_sharded_to_parquet(
+        _CRSP_monthly_file_query,
+        pool if pool is not None else connect_to_wrds(wrds_username),
+        path,
+        _extra_month(start_date),
+        end_date,
+        date_cols=["date", "namedt", "nameendt", "dlstdt"],
+        column_types=CRSP_MONTHLY_FILE_COLUMN_TYPES,
+        transform=_clean_CRSP_monthly_file,
+        max_workers=max_workers,
+    )
+    return manifest
+
+
 def apply_delisting_returns_alt(df):
     df["dlret"] = df["dlret"].fillna(0)
     df["ret"] = df["ret"] + df["dlret"]
@@ -156,7 +207,7 @@ def apply_delisting_returns_alt(df):
 
 
 def pull_CRSP_index_files(
-    start_date=START_DATE, end_date=END_DATE, wrds_username=WRDS_USERNAME
+    start_date=START_DATE, end_date=END_DATE, wrds_username=WRDS_USERNAME, pool=None
 ):
     """
     Pulls the CRSP index files from crsp_a_indexes.msix:
@@ -170,21 +221,57 @@ def pull_CRSP_index_files(
     """
     # with wrds.Connection(wrds_username=wrds_username) as db:
     #     df = db.raw_sql(query, date_cols=["month", "caldt"])
-    db = wrds.Connection(wrds_username=wrds_username)
-    df = db.raw_sql(query, date_cols=["caldt"])
-    db.close()
+    with wrds_connection(wrds_username, pool) as db:
+        df = db.raw_sql(query, date_cols=["caldt"])
     return df
 
 
-def load_CRSP_monthly_file(data_dir=DATA_DIR):
+def load_CRSP_monthly_file(
+    data_dir=DATA_DIR,
+    columns=None,
+    start_date=None,
+    end_date=None,
+    permnos=None,
+    filters=None,
+    library="pandas",
+):
+    """Load the monthly CRSP stock file, reading only `columns` and the
+    rows with `date` between `start_date` and `end_date` and `permno` in
+    `permnos`. See `misc_tools.load_parquet`.
+    """
     path = Path(data_dir) / "CRSP_MSF_INDEX_INPUTS.parquet"
-    df = pd.read_parquet(path)
+    df = load_parquet(
+        path,
+        columns=columns,
+        date_col="date",
+        start_date=start_date,
+        end_date=end_date,
+        id_col="permno",
+        ids=permnos,
+        filters=filters,
+        library=library,
+    )
     return df
 
 
-def load_CRSP_index_files(data_dir=DATA_DIR):
+def load_CRSP_index_files(
+    data_dir=DATA_DIR,
+    columns=None,
+    start_date=None,
+    end_date=None,
+    filters=None,
+    library="pandas",
+):
     path = Path(data_dir) / f"CRSP_MSIX.parquet"
-    df = pd.read_parquet(path)
+    df = load_parquet(
+        path,
+        columns=columns,
+        date_col="caldt",
+        start_date=start_date,
+        end_date=end_date,
+        filters=filters,
+        library=library,
+    )
     return df
 
 
@@ -194,11 +281,30 @@ def _demo():
 
 
 if __name__ == "__main__":
-
-    df_msf = pull_CRSP_monthly_file(start_date=START_DATE, end_date=END_DATE)
-    path = Path(DATA_DIR) / "CRSP_MSF_INDEX_INPUTS.parquet"
-    df_msf.to_parquet(path)
-
-    df_msix = pull_CRSP_index_files(start_date=START_DATE, end_date=END_DATE)
-    path = Path(DATA_DIR) / f"CRSP_MSIX.parquet"
-    df_msix.to_parquet(path)
+    # One lazily opened connection, shared by both pulls below
+    with ConnectionPool(connect_to_wrds(WRDS_USERNAME), max_size=1) as pool:
+        path = Path(DATA_DIR) / "CRSP_MSF_INDEX_INPUTS.parquet"
+        if PARTITION_CRSP:
+            df_msf = pull_CRSP_monthly_file(
+                start_date=START_DATE, end_date=END_DATE, pool=pool
+            )
+            partition_cols = ["year"]
+            if PARTITION_CRSP_BY_EXCHANGE:
+                partition_cols.append("exchcd")
+            write_partitioned_parquet(
+                df_msf,
+                path,
+                date_col="date",
+                partition_cols=partition_cols,
+                sort_by=["permno"],
+            )
+        else:
+            stream_CRSP_monthly_file(
+                path, start_date=START_DATE, end_date=END_DATE, pool=pool
+            )
+
+        df_msix = pull_CRSP_index_files(
+            start_date=START_DATE, end_date=END_DATE, pool=pool
+        )
+        path = Path(DATA_DIR) / f"CRSP_MSIX.parquet"
+        df_msix.to_parquet(path)
@@ -1,14 +1,21 @@
-import pandas_datareader.data as web
 import pandas as pd
-import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from misc_tools import load_parquet, make_session, step_function_overlay
 from settings import config
 
 DATA_DIR = Path(config("DATA_DIR"))
 START_DATE = config("START_DATE")
 END_DATE = config("END_DATE")
 
+FRED_CSV_URL = "https://fred.stlouisfed.org/graph/fredgraph.csv"
+FRED_CACHE_DIR = DATA_DIR / "fred_cache"
+
 
 series_to_pull = {
     ## Macro
@@ -78,13 +85,219 @@ manual_ONRRP_cntypty_limits = {  # in $ Billions
     "2021-Jun-3": 160,
 }
 
+manual_ONRP_agg_limits = {  # in $ Billions
+    "2021-Jul-28": 500,
+}
+
+
+def read_fred_csv(
+    series_id, start_date, end_date, base_url=FRED_CSV_URL, session=None, timeout=30
+):
+    """Download a single FRED series as CSV and return it indexed by date.
+
+    The response is parsed with the pyarrow CSV reader. FRED marks missing
+    observations with ".", which are read as NaN.
+    """
+    if session is None:
+        with make_session() as session:
+            return read_fred_csv(
+                series_id, start_date, end_date, base_url, session, timeout
+            )
+
+    start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    response = session.get(
+        base_url,
+        params={
+            "id": series_id,
+            "cosd": start_date.strftime("%Y-%m-%d"),
+            "coed": end_date.strftime("%Y-%m-%d"),
+        },
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    table = pa_csv.read_csv(
+        io.BytesIO(response.content),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={series_id: pa.float64()}, null_values=["."]
+        ),
+    )
+    dates = table.column(0).cast(pa.timestamp("ns")).to_pandas()
+    df = pd.DataFrame(
+        {series_id: table.column(series_id).to_numpy()},
+        index=pd.DatetimeIndex(dates, name="DATE"),
+    )
+    return df.loc[start_date:end_date]
+
+
+def _fetch_fred_series(requests_, base_url, max_workers, timeout=30, retries=3):
+    """Run `read_fred_csv` for each (series_id, start_date, end_date) in
+    `requests_` concurrently over one pooled session, keeping their order.
+    """
+    with make_session(pool_size=max_workers, retries=retries) as session:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(
+                    read_fred_csv,
+                    series_id,
+                    start_date,
+                    end_date,
+                    base_url=base_url,
+                    session=session,
+                    timeout=timeout,
+                )
+                for series_id, start_date, end_date in requests_
+            ]
+            return [future.result() for future in futures]
+
+
+def pull_fred_series(
+    series,
+    start_date=START_DATE,
+    end_date=END_DATE,
+    base_url=FRED_CSV_URL,
+    max_workers=8,
+    timeout=30,
+    retries=3,
+):
+    """Download the FRED series in `series` concurrently.
+
+    At most `max_workers` downloads are in flight over one pooled
+    `requests.Session`, each with a `timeout` and up to `retries` retries
+    with backoff. The series are outer-joined on the date index in a
+    single concat.
+    """
+    frames = _fetch_fred_series(
+        [(series_id, start_date, end_date) for series_id in series],
+        base_url=base_url,
+        max_workers=max_workers,
+        timeout=timeout,
+        retries=retries,
+    )
+    return pd.concat(frames, axis=1).sort_index()
+
+
+def _load_manifest(cache_dir):
+    path = Path(cache_dir) / "manifest.json"
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
 
-def pull_fred(start_date=START_DATE, end_date=END_DATE, ffill=True):
+
+def _write_manifest(cache_dir, manifest):
+    path = Path(cache_dir) / "manifest.json"
+    tmp_path = path.with_suffix(".json.tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    tmp_path.replace(path)
+
+
+def pull_fred_cached(
+    series,
+    start_date=START_DATE,
+    end_date=END_DATE,
+    cache_dir=FRED_CACHE_DIR,
+    max_age=pd.Timedelta(hours=12),
+    base_url=FRED_CSV_URL,
+    max_workers=8,
+):
+    """Pull raw FRED series through a local on-disk cache.
+
+    Each series is stored as `<cache_dir>/<series_id>.parquet`, and
+    `<cache_dir>/manifest.json` records, per series, the first and last
+    requested dates, the last observation date and when it was last
+    fetched. On later calls only the tail of each series is requested,
+    starting at the last cached observation (so that a revised last value
+    is picked up), and merged into the cache. A series is not fetched at
+    all if its observations already reach `end_date`, or if it was fetched
+    through `end_date` or later less than `max_age` ago.
+    A series is downloaded in full again when `start_date` is earlier than
+    what the cache holds. Stale series are downloaded concurrently, as in
+    `pull_fred_series`.
+
+    Returns the series outer-joined on the date index, restricted to
+    `start_date` through `end_date`.
+    """
+    start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    manifest = _load_manifest(cache_dir)
+    now = pd.Timestamp.now()
+
+    cached = {}
+    to_fetch = []
+    for series_id in series:
+        path = cache_dir / f"{series_id}.parquet"
+        entry = manifest.get(series_id)
+        if (
+            entry is None
+            or not path.exists()
+            or pd.Timestamp(entry["start_date"]) > start_date
+        ):
+            manifest[series_id] = {"start_date": start_date.strftime("%Y-%m-%d")}
+            to_fetch.append((series_id, start_date, end_date))
+            continue
+
+        cached[series_id] = pd.read_parquet(path)
+        last_observation = entry["last_observation"] or entry["start_date"]
+        fetch_start = pd.Timestamp(last_observation)
+        cached_end = entry.get("end_date")
+        is_fresh = fetch_start >= end_date or (
+            cached_end is not None
+            and pd.Timestamp(cached_end) >= end_date
+            and now - pd.Timestamp(entry["fetched_at"]) < max_age
+        )
+        if not is_fresh:
+            to_fetch.append((series_id, fetch_start, end_date))
+
+    fetched = _fetch_fred_series(to_fetch, base_url=base_url, max_workers=max_workers)
+    for (series_id, _, _), new in zip(to_fetch, fetched):
+        if series_id in cached:
+            new = pd.concat([cached[series_id], new])
+            new = new[~new.index.duplicated(keep="last")].sort_index()
+        new.to_parquet(cache_dir / f"{series_id}.parquet")
+        cached[series_id] = new
+
+        last_observation = new[series_id].last_valid_index()
+        manifest[series_id]["last_observation"] = (
+            None if last_observation is None else last_observation.strftime("%Y-%m-%d")
+        )
+        manifest[series_id]["fetched_at"] = now.isoformat()
+        cached_end = manifest[series_id].get("end_date")
+        if cached_end is None or pd.Timestamp(cached_end) < end_date:
+            manifest[series_id]["end_date"] = end_date.strftime("%Y-%m-%d")
+
+    _write_manifest(cache_dir, manifest)
+    df = pd.concat([cached[series_id] for series_id in series], axis=1).sort_index()
+    return df.loc[start_date:end_date]
+
+
+def pull_fred(
+    start_date=START_DATE,
+    end_date=END_DATE,
+    ffill=True,
+    cache_dir=None,
+    base_url=FRED_CSV_URL,
+):
     """
     Lookup series code, e.g., like this:
     https://fred.stlouisfed.org/series/RPONTSYD
+
+    The series are downloaded concurrently with `pull_fred_series`. If
+    `cache_dir` is given, they are pulled through the incremental on-disk
+    cache in `pull_fred_cached`, so that only the missing tail of each
+    series is downloaded.
     """
-    df = web.DataReader(list(series_to_pull.keys()), "fred", start_date, end_date)
+    if cache_dir is None:
+        df = pull_fred_series(
+            list(series_to_pull.keys()), start_date, end_date, base_url=base_url
+        )
+    else:
+        df = pull_fred_cached(
+            list(series_to_pull.keys()),
+            start_date,
+            end_date,
+            cache_dir=cache_dir,
+            base_url=base_url,
+        )
 
     millions_to_billions = ["TREAST", "GFDEBTN", "WALCL", "WSDONTL"]
     for s in millions_to_billions:
@@ -114,15 +327,10 @@ def pull_fred(start_date=START_DATE, end_date=END_DATE, ffill=True):
     df["Gen_IORB"] = df["IORB"].fillna(df["IOER"])
     # df['Gen_DISCOUNT'] = df['DPCREDIT'].fillna(df['DISCOUNT'])
 
-    df["ONRRP_CTPY_LIMIT"] = np.nan
-    for key in manual_ONRRP_cntypty_limits.keys():
-        date = pd.to_datetime(key)
-        df.loc[date, "ONRRP_CTPY_LIMIT"] = manual_ONRRP_cntypty_limits[key]
-    df["ONRRP_CTPY_LIMIT"] = df["ONRRP_CTPY_LIMIT"].ffill()
-
-    df["ONRP_AGG_LIMIT"] = np.nan
-    df.loc["2021-Jul-28", "ONRP_AGG_LIMIT"] = 500
-    df["ONRP_AGG_LIMIT"] = df["ONRP_AGG_LIMIT"].ffill()
+    df["ONRRP_CTPY_LIMIT"] = step_function_overlay(
+        df.index, manual_ONRRP_cntypty_limits
+    )
+    df["ONRP_AGG_LIMIT"] = step_function_overlay(df.index, manual_ONRP_agg_limits)
 
     df_focused = df.drop(columns=["IORR", "IOER", "IORB"])
     # df_focused.isna().sum()
@@ -131,12 +339,24 @@ def pull_fred(start_date=START_DATE, end_date=END_DATE, ffill=True):
     return df_focused
 
 
-def load_fred(data_dir=DATA_DIR):
+def load_fred(
+    data_dir=DATA_DIR, columns=None, start_date=None, end_date=None, library="pandas"
+):
     """
     Must first run this module as main to pull and save data.
+
+    Only `columns` and the dates between `start_date` and `end_date` are
+    read. See `misc_tools.load_parquet`.
     """
     file_path = Path(data_dir) / "fred.parquet"
-    df = pd.read_parquet(file_path)
+    df = load_parquet(
+        file_path,
+        columns=columns,
+        date_col="DATE",
+        start_date=start_date,
+        end_date=end_date,
+        library=library,
+    )
     # df = pd.read_csv(file_path, parse_dates=["DATE"])
     # df = df.set_index("DATE")
     return df
@@ -150,8 +370,8 @@ if __name__ == "__main__":
 
     today = pd.Timestamp.today().strftime("%Y-%m-%d")
     end_date = today
-    df = pull_fred(START_DATE, end_date)
-    filedir = Path(DATA_DIR) 
+    df = pull_fred(START_DATE, end_date, cache_dir=FRED_CACHE_DIR)
+    filedir = Path(DATA_DIR)
     filedir.mkdir(parents=True, exist_ok=True)
     df.to_parquet(filedir / "fred.parquet")
     df.to_csv(filedir / "fred.csv")
@@ -7,22 +7,62 @@ import pandas as pd
 import numpy as np
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+
+import requests
+
+from misc_tools import make_session
 from settings import config
 
-def pull_series_from_ofr_api(mnemonic=None):
+OFR_API_URL = "https://data.financialresearch.gov/v1"
+
+
+def _timeseries_to_frame(mnemonic, observations):
+    df = pd.DataFrame(observations, columns=["Date", mnemonic])
+    df["Date"] = pd.to_datetime(df["Date"])
+    df[mnemonic] = df[mnemonic].astype(float)
+    df = df.set_index("Date")
+    return df
+
+
+def pull_series_from_ofr_api(
+    mnemonic=None, session=None, timeout=30, base_url=OFR_API_URL
+):
     """
     An example:
     https://data.financialresearch.gov/v1/series/timeseries?mnemonic=REPO-TRI_AR_TOT-F
     """
-    df = pd.read_json(
-        f'https://data.financialresearch.gov/v1/series/timeseries?mnemonic={mnemonic}',
-                )
-    
-    df.columns=['Date', mnemonic]
-    df['Date'] = pd.to_datetime(df['Date'])
-    df = df.set_index('Date')
-    return df
+    session = requests if session is None else session
+    response = session.get(
+        f"{base_url}/series/timeseries",
+        params={"mnemonic": mnemonic},
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    return _timeseries_to_frame(mnemonic, response.json())
+
+
+def pull_series_batch_from_ofr_api(
+    mnemonics, session=None, timeout=30, base_url=OFR_API_URL
+):
+    """Pull several series in one request with the multi-series endpoint.
+
+    An example:
+    https://data.financialresearch.gov/v1/series/multifull?mnemonics=FNYR-BGCR-A,FNYR-TGCR-A
+    """
+    session = requests if session is None else session
+    response = session.get(
+        f"{base_url}/series/multifull",
+        params={"mnemonics": ",".join(mnemonics)},
+        timeout=timeout,
+    )
+    response.raise_for_status()
+    payload = response.json()
+    return [
+        _timeseries_to_frame(m, payload[m]["timeseries"]["aggregation"])
+        for m in mnemonics
+    ]
 
 series_descriptions = {
     'REPO-TRI_AR_OO-P': 'Tri-Party Average Rate: Overnight/Open (Preliminary)',
@@ -41,12 +81,44 @@ series_descriptions = {
     'FNYR-TGCR-A':'Tri-Party General Collateral Rate',
 }
 
-def pull_series_list(series_list = list(series_descriptions.keys())):
-    df_list = []
-    for s in series_list:
-        df = pull_series_from_ofr_api(mnemonic=s)
-        df_list.append(df)
-    df = pd.concat(df_list, axis=1)
+def pull_series_list(
+    series_list=list(series_descriptions.keys()),
+    batch_size=12,
+    max_workers=4,
+    timeout=30,
+    retries=3,
+    base_url=OFR_API_URL,
+):
+    """Pull the series in `series_list` concurrently.
+
+    The series are requested in batches of `batch_size` from the
+    multi-series endpoint (use batch_size=1 to request each series from
+    the single-series endpoint instead), with at most `max_workers`
+    requests in flight over one pooled session. Each request times out
+    after `timeout` seconds and is retried up to `retries` times with
+    backoff. The results are joined on the date index once at the end.
+    """
+    batches = [
+        series_list[i : i + batch_size] for i in range(0, len(series_list), batch_size)
+    ]
+
+    def pull_batch(batch):
+        if len(batch) == 1:
+            return [
+                pull_series_from_ofr_api(
+                    batch[0], session=session, timeout=timeout, base_url=base_url
+                )
+            ]
+        return pull_series_batch_from_ofr_api(
+            batch, session=session, timeout=timeout, base_url=base_url
+        )
+
+    with make_session(pool_size=max_workers, retries=retries) as session:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(pull_batch, batches))
+
+    df_list = [df for batch_frames in results for df in batch_frames]
+    df = pd.concat(df_list, axis=1).sort_index()
     return df
 
 if __name__ == "__main__":
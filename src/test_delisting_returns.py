@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import polars as pl
+import pytest
+
+from delisting_returns import apply_delisting_returns
+
+
+@pytest.fixture
+def delisted():
+    # One row per rule: active, missing code, generic delisting, the
+    # performance codes and their neighbours, and an observed dlret
+    return pd.DataFrame(
+        {
+            "dlstcd": [100, np.nan, 241, 500, 520, 550, 551, 574, 575, 584, 560],
+            "dlret": [np.nan] * 10 + [0.05],
+            "dlretx": [np.nan] * 10 + [0.04],
+            "ret": [np.nan] * 9 + [0.02, np.nan],
+            "retx": [np.nan] * 9 + [0.01, np.nan],
+        }
+    )
+
+
+EXPECTED_DLRET = [np.nan, np.nan, -1, -0.3, -0.3, -1, -0.3, -0.3, -1, -0.3, 0.05]
+
+
+def test_apply_delisting_returns_pandas(delisted):
+    df = apply_delisting_returns(delisted)
+    np.testing.assert_array_equal(df["dlret"], EXPECTED_DLRET)
+    np.testing.assert_array_equal(df["dlretx"], EXPECTED_DLRET[:-1] + [0.04])
+    # Missing returns take the delisting return, observed returns are kept
+    np.testing.assert_array_equal(df["ret"], EXPECTED_DLRET[:-2] + [0.02, 0.05])
+    np.testing.assert_array_equal(df["retx"], EXPECTED_DLRET[:-2] + [0.01, 0.04])
+
+
+def test_apply_delisting_returns_polars_matches_pandas(delisted):
+    expected = apply_delisting_returns(delisted.copy())
+    result = apply_delisting_returns(pl.from_pandas(delisted), library="polars")
+    lazy = apply_delisting_returns(
+        pl.from_pandas(delisted).lazy(), library="polars"
+    ).collect()
+    assert result.equals(lazy)
+    pd.testing.assert_frame_equal(result.to_pandas(), expected)
+
+    with pytest.raises(ValueError):
+        apply_delisting_returns(delisted, library="numpy")
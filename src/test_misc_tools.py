@@ -1,10 +1,50 @@
+import base64
+import io
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+import numpy as np
 import pandas as pd
+import pytest
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from matplotlib import pyplot as plt
 from misc_tools import (
     weighted_average,
     groupby_weighted_average,
     groupby_weighted_std,
+    groupby_weighted_quantile,
+    plot_weighted_median_with_distribution_bars,
+    weighted_quantile,
     get_most_recent_quarter_end,
     get_next_quarter_start,
+    calc_check_digit,
+    calc_check_digit_expr,
+    convert_cusips_from_8_to_9_digit,
+    validate_cusips,
+    validate_cusips_expr,
+    with_lagged_columns,
+    with_panel_lags,
+    leave_one_out_sums,
+    leave_one_out_means,
+    merge_stats,
+    dataframe_set_difference,
+    get_end_of_current_month,
+    get_end_of_current_quarter,
+    freq_counts,
+    df_to_literal,
+    move_columns_to_front,
+    reorder_columns,
+    step_function_overlay,
+    load_parquet,
+    write_partitioned_parquet,
+    stream_sql_to_parquet,
+    pull_sharded_to_parquet,
+    ConnectionPool,
+    refresh_partitioned_parquet,
+    sharded_pull_complete,
 )
 
 
@@ -80,3 +120,934 @@ def test_get_next_quarter_start():
     result = get_next_quarter_start(d)
     expected = pd.Timestamp("2020-01-01")
     assert result == expected
+
+
+def test_groupby_weighted_std_matches_apply():
+    df = pd.DataFrame(
+        {
+            "date": [1, 1, 1, 2, 2, 2, 2, 3, 3],
+            "rate": [2.0, 2.5, 4.0, 1.0, 1.0, 3.0, 5.0, 7.0, 8.0],
+            "volume": [10.0, 30.0, 5.0, 1.0, 2.0, 3.0, 4.0, 6.0, 2.0],
+        }
+    )
+
+    def weighted_sd(input_df, ddof):
+        weights = input_df["volume"]
+        vals = input_df["rate"]
+        weighted_avg = np.average(vals, weights=weights)
+        numer = np.sum(weights * (vals - weighted_avg) ** 2)
+        denom = ((vals.count() - ddof) / vals.count()) * np.sum(weights)
+        return np.sqrt(numer / denom)
+
+    for ddof in [0, 1]:
+        expected = df.groupby("date")[["rate", "volume"]].apply(weighted_sd, ddof=ddof)
+        result = groupby_weighted_std(
+            data_col="rate", weight_col="volume", by_col="date", data=df, ddof=ddof
+        )
+        pd.testing.assert_series_equal(result, expected)
+
+        result_pl = groupby_weighted_std(
+            data_col="rate",
+            weight_col="volume",
+            by_col="date",
+            data=pl.from_pandas(df),
+            ddof=ddof,
+            library="polars",
+        )
+        np.testing.assert_allclose(result_pl["rate"].to_numpy(), expected.to_numpy())
+
+
+def test_groupby_weighted_quantile_matches_weighted_quantile():
+    df = pd.DataFrame(
+        {
+            "date": [1, 1, 1, 1, 2, 2, 2, 3, 4, 4],
+            "rate": [2.0, 0.5, 4.0, 1.5, 1.0, 3.0, 5.0, 7.0, 8.0, 6.0],
+            "volume": [10.0, 30.0, 5.0, 0.0, 2.0, 3.0, 4.0, 6.0, 0.0, 0.0],
+        }
+    )
+    quantiles = [0.0, 0.1, 0.25, 0.5, 0.75, 1.0]
+    result = groupby_weighted_quantile(
+        df, value_col="rate", weight_col="volume", by_col="date", quantiles=quantiles
+    )
+    assert list(result.columns) == quantiles
+    assert list(result.index) == [1, 2, 3, 4]
+    for date in [1, 2, 3]:
+        sub_df = df[df["date"] == date]
+        expected = weighted_quantile(
+            sub_df["rate"], quantiles, sample_weight=sub_df["volume"]
+        )
+        np.testing.assert_allclose(result.loc[date].to_numpy(), expected)
+    # Groups without positive total weight have no defined quantiles
+    assert result.loc[4].isna().all()
+
+
+def test_plot_weighted_median_with_distribution_bars_returns_data():
+    df = pd.DataFrame(
+        {
+            "date": pd.to_datetime(["2020-01-01"] * 3 + ["2020-01-02"] * 4),
+            "rate": [1, 2, 3, 4, 1, 2, 3],
+            "volume": [1, 1, 1, 1, 1, 1, 1],
+        }
+    )
+    kwargs = dict(
+        data=df,
+        variable_name="rate",
+        date_col="date",
+        weight_col="volume",
+        rescale_factor=100,
+    )
+    ax, quantile_df = plot_weighted_median_with_distribution_bars(
+        **kwargs, return_data=True
+    )
+    expected = pd.DataFrame(
+        {"median": [200.0, 250.0], "lower": [125.0, 150.0], "upper": [275.0, 350.0]},
+        index=pd.Index(pd.to_datetime(["2020-01-01", "2020-01-02"]), name="date"),
+    )
+    pd.testing.assert_frame_equal(quantile_df, expected)
+    np.testing.assert_allclose(ax.get_lines()[0].get_ydata(), [200.0, 250.0])
+
+    # By default only the axes are returned
+    ax = plot_weighted_median_with_distribution_bars(**kwargs)
+    assert isinstance(ax, plt.Axes)
+    plt.close("all")
+
+
+def test_convert_cusips_from_8_to_9_digit():
+    cusips = pd.Series(["03783310", "17275R10", "38259P50", "59491810", "00724F10"])
+    result = convert_cusips_from_8_to_9_digit(cusips)
+    expected = pd.Series(
+        ["037833100", "17275R102", "38259P508", "594918104", "00724F101"]
+    )
+    pd.testing.assert_series_equal(result, expected)
+    assert calc_check_digit("03783310") == "0"
+
+    result_pl = pl.DataFrame({"cusip": cusips.to_numpy()}).select(
+        pl.col("cusip") + calc_check_digit_expr("cusip")
+    )
+    assert result_pl["cusip"].to_list() == expected.to_list()
+
+
+def test_validate_cusips():
+    cusips = ["037833100", "037833101", "0378331", "0378331000", "03783a100", None]
+    expected = [True, False, False, False, False, False]
+    assert validate_cusips(pd.Series(cusips)).tolist() == expected
+
+    result_pl = pl.DataFrame({"cusip": cusips}).select(validate_cusips_expr("cusip"))
+    assert result_pl["cusip"].to_list() == expected
+
+
+def test_with_lagged_columns_respects_gaps():
+    df = pd.DataFrame(
+        {
+            "id": ["B", "A", "A", "B", "B", "B"],
+            "date": pd.to_datetime(
+                [
+                    "1990-02-01",
+                    "1990-01-01",
+                    "1990-03-01",
+                    "1990-01-01",
+                    "1990-03-01",
+                    "1990-04-01",
+                ]
+            ),
+            "value": [2.0, 1.0, 3.0, 1.0, 3.0, 4.0],
+            "size": [20.0, 10.0, 30.0, 10.0, 30.0, 40.0],
+        }
+    )
+    result = with_lagged_columns(
+        df=df,
+        column_to_lag=["value", "size"],
+        id_column="id",
+        lags=[1, -1],
+        freq="MS",
+    )
+    assert list(result.index) == [1, 2, 3, 0, 4, 5]
+    np.testing.assert_array_equal(
+        result["L1_value"], [np.nan, np.nan, np.nan, 1.0, 2.0, 3.0]
+    )
+    np.testing.assert_array_equal(
+        result["L-1_size"], [np.nan, np.nan, 20.0, 30.0, 40.0, np.nan]
+    )
+
+
+def test_with_panel_lags():
+    df = pd.DataFrame(
+        {
+            "permno": [2, 1, 1, 2, 1, 2],
+            "date": pd.to_datetime(
+                [
+                    "2000-02-29",
+                    "2000-03-31",
+                    "2000-01-31",
+                    "2000-01-31",
+                    "2000-02-29",
+                    "2000-03-31",
+                ]
+            ),
+            "ret": [0.2, 0.3, 0.1, 0.1, 0.2, 0.3],
+            "me": [20, 30, 10, 10, 20, 30],
+        }
+    )
+    sorted_df = df.sort_values(["permno", "date"])
+    result = with_panel_lags(
+        df=df, columns=["ret", "me"], id_columns="permno", lags=[1, 2, -1]
+    )
+    pd.testing.assert_index_equal(result.index, sorted_df.index)
+    for lag in [1, 2, -1]:
+        for col in ["ret", "me"]:
+            expected = sorted_df.groupby("permno")[col].shift(lag)
+            pd.testing.assert_series_equal(
+                result[f"L{lag}_{col}"], expected, check_names=False
+            )
+
+    result_pl = with_panel_lags(
+        df=pl.from_pandas(df).lazy(),
+        columns=["ret", "me"],
+        id_columns="permno",
+        lags=[1, 2, -1],
+        library="polars",
+    ).collect()
+    for name in ["L1_ret", "L2_me", "L-1_ret"]:
+        np.testing.assert_allclose(
+            result_pl[name].to_numpy().astype(float), result[name].to_numpy()
+        )
+
+
+def test_leave_one_out_sums_and_means():
+    df = pd.DataFrame(
+        {
+            "industry": ["a", "a", "a", "b", "b"],
+            "emp": [1.0, np.nan, 5.0, 2.0, 4.0],
+            "wage": [10.0, 20.0, 30.0, 40.0, 50.0],
+            "weight": [1.0, 2.0, 3.0, 1.0, 1.0],
+        }
+    )
+    result = leave_one_out_sums(df, groupby=["industry"], summed_col=["emp", "wage"])
+    np.testing.assert_array_equal(result["emp"], [5.0, 6.0, 1.0, 4.0, 2.0])
+    np.testing.assert_array_equal(result["wage"], [50.0, 40.0, 30.0, 50.0, 40.0])
+
+    result = leave_one_out_sums(
+        df, groupby=["industry"], summed_col="wage", weight_col="weight"
+    )
+    np.testing.assert_array_equal(result, [130.0, 100.0, 50.0, 50.0, 40.0])
+
+    result = leave_one_out_means(df, groupby=["industry"], mean_col="emp")
+    np.testing.assert_array_equal(result, [5.0, 3.0, 1.0, 4.0, 2.0])
+
+    result_pl = leave_one_out_means(
+        pl.from_pandas(df), groupby=["industry"], mean_col="emp", library="polars"
+    )
+    np.testing.assert_array_equal(result_pl.to_numpy(), [5.0, 3.0, 1.0, 4.0, 2.0])
+
+
+def test_groupby_weighted_average_does_not_mutate():
+    df = pd.DataFrame(
+        {
+            "trade_direction": ["RECEIVED", "RECEIVED", "DELIVERED", "DELIVERED"],
+            "rate": [2.0, 3.0, 2.0, np.nan],
+            "spread": [0.1, 0.4, 0.2, 0.3],
+            "start_leg_amount": [100, 200, 100, 300],
+        },
+        index=[7, 5, 3, 1],
+    )
+    df_before = df.copy()
+    result = groupby_weighted_average(
+        data_col=["rate", "spread"],
+        weight_col="start_leg_amount",
+        by_col="trade_direction",
+        data=df,
+    )
+    pd.testing.assert_frame_equal(df, df_before)
+    np.testing.assert_allclose(result["rate"], [2.0, 8 / 3])
+    np.testing.assert_allclose(result["spread"], [0.275, 0.3])
+
+    result = groupby_weighted_average(
+        data_col="rate",
+        weight_col="start_leg_amount",
+        by_col="trade_direction",
+        data=df,
+        transform=True,
+        new_column_name="wavg_rate",
+    )
+    expected = pd.Series([8 / 3, 8 / 3, 2.0, 2.0], index=df.index, name="wavg_rate")
+    pd.testing.assert_series_equal(result, expected)
+
+    result_pl = groupby_weighted_average(
+        data_col="rate",
+        weight_col="start_leg_amount",
+        by_col="trade_direction",
+        data=pl.from_pandas(df).lazy(),
+        library="polars",
+    ).collect()
+    np.testing.assert_allclose(result_pl["rate"].to_numpy(), [2.0, 8 / 3])
+
+
+def test_merge_stats_methods_agree(tmp_path):
+    df_left = pd.DataFrame(
+        {
+            "permno": [1, 1, 2, 3, 3, 4],
+            "date": pd.to_datetime(
+                [
+                    "2000-01-31",
+                    "2000-01-31",
+                    "2000-01-31",
+                    "2000-02-29",
+                    "2000-03-31",
+                    "2000-01-31",
+                ]
+            ),
+        }
+    )
+    df_right = pd.DataFrame(
+        {
+            "permno": [1, 2, 3, 5],
+            "date": pd.to_datetime(
+                ["2000-01-31", "2000-02-29", "2000-03-31", "2000-01-31"]
+            ),
+        }
+    )
+    expected = merge_stats(df_left, df_right, on=["permno", "date"])
+    assert expected["left"] == 5
+    assert expected["right"] == 4
+    assert expected["intersection"] == 2
+    assert expected["union"] == 7
+
+    right_path = tmp_path / "right.parquet"
+    df_right.to_parquet(right_path)
+    result = merge_stats(
+        df_left, right_path, on=["permno", "date"], method="hash", chunksize=2
+    )
+    pd.testing.assert_series_equal(result, expected)
+    result = merge_stats(
+        pl.from_pandas(df_left).lazy(),
+        right_path,
+        on=["permno", "date"],
+        method="polars",
+    )
+    pd.testing.assert_series_equal(result, expected)
+
+    # Keys of different numeric dtypes are compared by value, as for a float
+    # lpermno against an int permno
+    permnos = pd.DataFrame({"permno": [10001, 10002, 10003]})
+    lpermnos = pd.DataFrame({"permno": [10001.0, 10002.0, np.nan]})
+    lpermnos_path = tmp_path / "lpermnos.parquet"
+    lpermnos.to_parquet(lpermnos_path)
+    expected = merge_stats(permnos, lpermnos, on="permno")
+    assert expected["intersection"] == 2
+    assert expected["union"] == 4
+    for method in ["hash", "polars"]:
+        result = merge_stats(permnos, lpermnos, on="permno", method=method)
+        pd.testing.assert_series_equal(result, expected)
+        result = merge_stats(lpermnos_path, permnos, on="permno", method=method)
+        assert result["intersection"] == 2
+        assert result["union"] == 4
+
+    with pytest.raises(ValueError):
+        merge_stats(permnos.astype(str), lpermnos, on="permno", method="hash")
+
+
+def test_dataframe_set_difference():
+    dff = pd.DataFrame(
+        {"a": [1.0, 2.0, 3.0, 4.0, np.nan], "b": ["x", "y", "z", "w", "v"]},
+        index=[10, 11, 12, 13, 14],
+    )
+    df = pd.DataFrame({"a": [2.0, 4.0, np.nan], "b": ["y", "q", "v"]})
+    row_numbers, rows = dataframe_set_difference(dff, df)
+    assert row_numbers == [0, 2, 3]
+    pd.testing.assert_frame_equal(rows, dff.iloc[[0, 2, 3]])
+
+    row_numbers, rows = dataframe_set_difference(
+        pl.from_pandas(dff), pl.from_pandas(df), library="polars"
+    )
+    assert row_numbers == [0, 2, 3]
+    assert rows["b"].to_list() == ["x", "z", "w"]
+
+    # Different dtypes are compared by value, without truncating 2.5 to 2
+    dff = pd.DataFrame({"a": [1, 2, 3]})
+    df = pd.DataFrame({"a": [1.0, 2.5]})
+    row_numbers, rows = dataframe_set_difference(dff, df)
+    assert row_numbers == [1, 2]
+    pd.testing.assert_frame_equal(rows, dff.iloc[[1, 2]])
+    with pytest.raises(ValueError):
+        dataframe_set_difference(dff, df.astype(str))
+
+
+def test_date_helpers_on_series():
+    dates = pd.Series(
+        pd.to_datetime(
+            ["2019-10-21 00:00:00", "2023-03-31 12:00:00", "1960-02-29 00:00:00", None]
+        ),
+        index=[3, 2, 1, 0],
+        name="datadate",
+    )
+    helpers = [
+        get_most_recent_quarter_end,
+        get_next_quarter_start,
+        get_end_of_current_month,
+        get_end_of_current_quarter,
+    ]
+    for helper in helpers:
+        result = helper(dates)
+        assert result.name == "datadate"
+        pd.testing.assert_index_equal(result.index, dates.index)
+        assert pd.isna(result.iloc[3])
+        for d, r in zip(dates.iloc[:3], result.iloc[:3]):
+            assert r == pd.Timestamp(helper(d))
+
+        result_pl = pl.DataFrame({"datadate": dates.iloc[:3].to_numpy()}).select(
+            helper(pl.col("datadate"))
+        )
+        assert result_pl["datadate"].to_list() == result.iloc[:3].tolist()
+
+    # Time zone aware dates are handled in local wall time, not in UTC
+    d = pd.Timestamp("2020-03-31 22:00", tz="US/Eastern")
+    assert get_end_of_current_month(d) == pd.Timestamp("2020-03-31", tz="US/Eastern")
+    assert get_most_recent_quarter_end(d) == pd.Timestamp("2019-12-31", tz="US/Eastern")
+    result = get_end_of_current_month(pd.Series([d]))
+    assert result.iloc[0] == pd.Timestamp("2020-03-31", tz="US/Eastern")
+
+
+def test_freq_counts_lazy_multi_column_weighted(tmp_path):
+    df = pl.DataFrame(
+        {
+            "exch": ["N", "Q", "N", "A", "N"],
+            "share": [1, 1, 2, 2, 1],
+            "shrout": [1.0, 2.0, 3.0, 4.0, 5.0],
+        }
+    )
+    path = tmp_path / "df.parquet"
+    df.write_parquet(path)
+
+    result = freq_counts(pl.scan_parquet(path), col="exch")
+    assert result["exch"].to_list() == ["N", "A", "Q"]
+    assert result["count"].to_list() == [3, 1, 1]
+    np.testing.assert_allclose(result["cum_freq"].to_numpy(), [60.0, 80.0, 100.0])
+
+    result = freq_counts(df.lazy(), col=["exch", "share"], weight_col="shrout")
+    assert result.rows()[0][:3] == ("N", 1, 6.0)
+    np.testing.assert_allclose(
+        result["freq"].to_numpy(), [40.0, 26.0 + 2 / 3, 20.0, 13.0 + 1 / 3]
+    )
+
+
+def test_df_to_literal_round_trip(tmp_path):
+    df = pd.DataFrame(
+        {
+            "sector": ["Financial", None, "Energy"],
+            "at": [1.5, np.nan, 3.0],
+            "datadate": pd.to_datetime(["2020-12-31", None, "2021-12-31"]),
+        },
+        index=["a", "b", "c"],
+    )
+    code = df_to_literal(df, chunksize=2)
+    assert "'Financial'" in code
+    namespace = {"pd": pd}
+    exec(code, namespace)
+    pd.testing.assert_frame_equal(namespace["df"], df)
+
+    path = tmp_path / "fixture.py"
+    df_to_literal(df, file=path, chunksize=2)
+    assert path.read_text() == code
+
+    code = df_to_literal(df, compact=True)
+    namespace = {"pd": pd, "base64": base64, "io": io}
+    exec(code, namespace)
+    pd.testing.assert_frame_equal(namespace["df"], df)
+
+
+def test_reorder_columns_matches_move_columns_to_front():
+    df = pd.DataFrame(
+        np.arange(12).reshape(2, 6),
+        columns=["at", "sale", "gvkey", "datadate", "xint", "xsga"],
+    )
+    reordered = reorder_columns(df, cols=["gvkey", "datadate"])
+    move_columns_to_front(df, cols=["gvkey", "datadate"])
+    pd.testing.assert_frame_equal(reordered, df)
+
+    reordered = reorder_columns(df, cols=["sale"], regex="^x")
+    assert reordered.columns.tolist() == [
+        "sale",
+        "xint",
+        "xsga",
+        "gvkey",
+        "datadate",
+        "at",
+    ]
+
+    pl_df = pl.from_pandas(df)
+    result = reorder_columns(pl_df, cols=["sale"], regex="^x", library="polars")
+    assert result.columns == reordered.columns.tolist()
+    assert result.to_pandas().equals(reordered)
+
+    # A misspelled column fails loudly, as in move_columns_to_front
+    with pytest.raises(KeyError):
+        reorder_columns(df, cols=["gvkey", "datdate"])
+
+
+def test_step_function_overlay_matches_loc_and_ffill():
+    limits = {"2013-Sep-22": 0, "2013-Sep-23": 1, "2014-Jan-29": 3, "2021-Jun-3": 160}
+    index = pd.bdate_range("2013-09-01", "2021-12-31", name="DATE")
+
+    expected = pd.Series(np.nan, index=index)
+    for key, value in limits.items():
+        expected.loc[pd.to_datetime(key)] = value
+    expected = expected.ffill().reindex(index)
+
+    result = step_function_overlay(index, limits)
+    pd.testing.assert_series_equal(result, expected, check_freq=False)
+    assert len(result) == len(index)
+
+    table = pd.DataFrame(
+        {"a": [1.0, 2.0], "b": [10.0, 20.0]},
+        index=pd.to_datetime(["2021-01-05", "2021-01-02"]),
+    )
+    result = step_function_overlay(index[::-1], table, before=0.0)
+    assert result.index.equals(index[::-1])
+    assert result.loc["2021-01-04"].tolist() == [2.0, 20.0]
+    assert result.loc["2021-01-05"].tolist() == [1.0, 10.0]
+    assert result.loc["2020-12-31"].tolist() == [0.0, 0.0]
+
+    result = step_function_overlay(index, {})
+    assert len(result) == len(index) and result.isna().all()
+    result = step_function_overlay(index, table.iloc[:0], before=0.0)
+    assert result.columns.tolist() == ["a", "b"]
+    assert (result.to_numpy() == 0.0).all()
+
+
+def test_load_parquet_projects_and_filters(tmp_path):
+    df = pd.DataFrame(
+        {
+            "date": np.repeat(pd.date_range("2000-01-31", periods=36, freq="ME"), 4),
+            "permno": np.tile([10001, 10002, 10003, 10004], 36),
+            "ret": np.arange(144) / 100,
+            "prc": 1.0,
+        }
+    )
+    path = tmp_path / "msf.parquet"
+    df.to_parquet(path, row_group_size=12)
+
+    result = load_parquet(
+        path,
+        columns=["date", "permno", "ret"],
+        date_col="date",
+        start_date="2001-01-01",
+        end_date="2001-12-31",
+        id_col="permno",
+        ids=[10002, 10004],
+        filters=[("ret", ">", 0.6)],
+    )
+    expected = df.loc[
+        (df["date"].dt.year == 2001)
+        & df["permno"].isin([10002, 10004])
+        & (df["ret"] > 0.6),
+        ["date", "permno", "ret"],
+    ].reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected)
+
+    result = load_parquet(
+        path, date_col="date", start_date="2002-06-30", library="polars"
+    )
+    assert isinstance(result, pl.DataFrame)
+    assert result.height == 7 * 4
+    result = load_parquet(path, columns=["ret"], library="arrow")
+    assert result.column_names == ["ret"]
+
+
+def test_write_partitioned_parquet_prunes_partitions(tmp_path):
+    df = pd.DataFrame(
+        {
+            "date": np.repeat(pd.date_range("2000-01-31", periods=36, freq="ME"), 4),
+            "permno": np.tile([10004, 10003, 10002, 10001], 36),
+            "exchcd": np.tile([1, 2, 3, 3], 36),
+            "ret": np.arange(144) / 100,
+        }
+    )
+    path = tmp_path / "msf.parquet"
+    # A single file from an unpartitioned pull is replaced by the dataset
+    df.iloc[:4].to_parquet(path)
+    write_partitioned_parquet(
+        df, path, date_col="date", partition_cols=["year", "exchcd"], sort_by=["permno"]
+    )
+    assert sorted(p.name for p in path.iterdir()) == [
+        "_common_metadata",
+        "year=2000",
+        "year=2001",
+        "year=2002",
+    ]
+
+    # The columns of df come back in their order and types, without "year"
+    result = load_parquet(path)
+    expected = df.sort_values(["date", "exchcd", "permno"], ignore_index=True)
+    pd.testing.assert_frame_equal(
+        result.sort_values(["date", "exchcd", "permno"], ignore_index=True), expected
+    )
+
+    # Partitions outside of the requested years are never opened
+    for file in (path / "year=2002").glob("*/*.parquet"):
+        file.write_bytes(b"not parquet")
+
+    result = load_parquet(
+        path,
+        columns=["date", "permno", "ret"],
+        date_col="date",
+        start_date="2001-03-01",
+        end_date="2001-12-31",
+        filters=[("exchcd", "=", 3)],
+    )
+    expected = df.loc[
+        (df["date"] >= "2001-03-01")
+        & (df["date"].dt.year == 2001)
+        & (df["exchcd"] == 3),
+        ["date", "permno", "ret"],
+    ]
+    expected = expected.sort_values(["date", "permno"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_stream_sql_to_parquet_sqlite(tmp_path):
+    df = pd.DataFrame(
+        {
+            "date": pd.date_range("2000-01-31", periods=25, freq="ME").strftime(
+                "%Y-%m-%d"
+            ),
+            "permno": np.arange(25),
+            "shrout": np.arange(25) * 1.5,
+            # Missing in the whole first chunk
+            "dlret": [None] * 10 + list(np.linspace(-1, 1, 15)),
+        }
+    )
+    con = sqlite3.connect(":memory:")
+    df.to_sql("msf", con, index=False)
+
+    path = tmp_path / "msf.parquet"
+    n_rows = stream_sql_to_parquet(
+        "SELECT * FROM msf ORDER BY permno",
+        con,
+        path,
+        chunksize=10,
+        date_cols=["date"],
+        column_types={"dlret": pa.float64()},
+        transform=lambda chunk: chunk.assign(shrout=chunk["shrout"] * 1000),
+    )
+    assert n_rows == 25
+    assert pq.ParquetFile(path).metadata.num_row_groups == 3
+
+    expected = df.assign(
+        date=pd.to_datetime(df["date"]),
+        shrout=df["shrout"] * 1000,
+        dlret=df["dlret"].astype(float),
+    )
+    pd.testing.assert_frame_equal(pd.read_parquet(path), expected)
+
+
+def test_pull_sharded_to_parquet_retries_and_resumes(tmp_path):
+    df = pd.DataFrame(
+        {
+            "datadate": pd.date_range("2000-01-31", periods=48, freq="ME").strftime(
+                "%Y-%m-%d"
+            ),
+            "gvkey": np.arange(48),
+            "at": np.arange(48) * 2.0,
+        }
+    )
+    db_path = tmp_path / "comp.sqlite"
+    with sqlite3.connect(db_path) as con:
+        df.to_sql("funda", con, index=False)
+
+    queries = []
+
+    def make_query(start_date, end_date):
+        queries.append(start_date)
+        if start_date.startswith("2002") and fail_2002:
+            return "SELECT * FROM no_such_table"
+        return f"""
+            SELECT * FROM funda
+            WHERE datadate BETWEEN '{start_date}' AND '{end_date}'
+            """
+
+    def connect():
+        return sqlite3.connect(db_path, check_same_thread=False)
+
+    kwargs = dict(
+        date_cols=["datadate"],
+        transform=lambda chunk: chunk.assign(year=chunk["datadate"].dt.year),
+        retries=1,
+        backoff=0,
+    )
+    path = tmp_path / "comp.parquet"
+    fail_2002 = True
+    with pytest.raises(RuntimeError, match="year=2002"):
+        pull_sharded_to_parquet(
+            make_query, connect, path, "2000-01-01", "2003-12-31", **kwargs
+        )
+    assert queries.count("2002-01-01") == 2
+    assert not (path / "year=2002" / "part-0.parquet").exists()
+
+    # Only the failed shard is pulled again
+    queries.clear()
+    fail_2002 = False
+    manifest = pull_sharded_to_parquet(
+        make_query, connect, path, "2000-01-01", "2003-12-31", **kwargs
+    )
+    assert queries == ["2002-01-01"]
+    assert sorted(manifest) == ["year=2000", "year=2001", "year=2002", "year=2003"]
+    assert manifest["year=2002"]["rows"] == 12
+
+    result = load_parquet(path).sort_values("datadate", ignore_index=True)
+    assert result["gvkey"].tolist() == df["gvkey"].tolist()
+    # The year added by the transform comes back in place from the partitions
+    assert result.columns.tolist() == [*df.columns, "year"]
+    assert (result["year"] == result["datadate"].dt.year).all()
+
+    result = load_parquet(path, date_col="datadate", start_date="2003-01-01")
+    assert result["gvkey"].tolist() == list(range(36, 48))
+
+
+def test_pull_sharded_to_parquet_removes_shard_pulled_again_empty(tmp_path):
+    df = pd.DataFrame(
+        {
+            "datadate": pd.date_range("2000-01-31", periods=24, freq="ME").strftime(
+                "%Y-%m-%d"
+            ),
+            "gvkey": np.arange(24),
+        }
+    )
+    db_path = tmp_path / "comp.sqlite"
+    with sqlite3.connect(db_path) as con:
+        df.to_sql("funda", con, index=False)
+
+    def make_query(start_date, end_date):
+        return f"""
+            SELECT * FROM funda
+            WHERE datadate BETWEEN '{start_date}' AND '{end_date}'
+            """
+
+    def connect():
+        return sqlite3.connect(db_path, check_same_thread=False)
+
+    path = tmp_path / "comp.parquet"
+    kwargs = dict(date_cols=["datadate"], backoff=0)
+    manifest = pull_sharded_to_parquet(
+        make_query, connect, path, "2000-01-01", "2001-06-30", **kwargs
+    )
+    assert manifest["year=2001"]["rows"] == 6
+    assert (path / "year=2001" / "part-0.parquet").exists()
+
+    # The 2001 rows are gone when the shard is pulled again for a later end date
+    with sqlite3.connect(db_path) as con:
+        con.execute("DELETE FROM funda WHERE datadate >= '2001-01-01'")
+    manifest = pull_sharded_to_parquet(
+        make_query, connect, path, "2000-01-01", "2001-12-31", **kwargs
+    )
+    assert manifest["year=2001"]["rows"] == 0
+    assert pq.read_metadata(path / "year=2001" / "part-0.parquet").num_rows == 0
+    result = load_parquet(path)
+    assert result["gvkey"].tolist() == list(range(12))
+
+
+def test_connection_pool_is_lazy_and_replaces_broken_connections(tmp_path):
+    db_path = tmp_path / "db.sqlite"
+    opened = []
+
+    def connect():
+        con = sqlite3.connect(db_path, check_same_thread=False)
+        opened.append(con)
+        return con
+
+    with ConnectionPool(connect, max_size=2) as pool:
+        assert opened == []
+        with pool.connection() as con:
+            con.execute("CREATE TABLE t (x INTEGER)")
+        with pool.connection() as con:
+            con.execute("INSERT INTO t VALUES (1)")
+        assert len(opened) == 1
+
+        # A connection that fails the health check is replaced
+        opened[0].close()
+        with pool.connection() as con:
+            assert con is opened[1]
+            assert con.execute("SELECT count(*) FROM t").fetchone() == (0,)
+
+        # So is one in use when an exception is raised
+        with pytest.raises(sqlite3.OperationalError):
+            with pool.connection() as con:
+                con.execute("SELECT * FROM no_such_table")
+        with pool.connection() as con:
+            assert con is opened[2]
+
+        # At most max_size connections are open at once
+        with ExitStack() as stack, ThreadPoolExecutor(max_workers=1) as executor:
+            held = [stack.enter_context(pool.connection()) for _ in range(2)]
+
+            def borrow():
+                with pool.connection() as con:
+                    return con
+
+            future = executor.submit(borrow)
+            with pytest.raises(TimeoutError):
+                future.result(timeout=0.2)
+            stack.close()
+            assert future.result(timeout=5) in held
+        assert len(opened) == 4
+
+
+def test_connection_pool_closes_connections_returned_after_close(tmp_path):
+    pool = ConnectionPool(lambda: sqlite3.connect(tmp_path / "db.sqlite"))
+    with pool.connection() as borrowed:
+        with pool.connection() as idle:
+            pass
+        pool.close()
+        with pytest.raises(sqlite3.ProgrammingError):
+            idle.execute("SELECT 1")
+        borrowed.execute("SELECT 1")
+    # A connection borrowed when the pool was closed is closed on return
+    with pytest.raises(sqlite3.ProgrammingError):
+        borrowed.execute("SELECT 1")
+
+
+def test_refresh_partitioned_parquet_upserts_recent_rows(tmp_path):
+    dates = pd.date_range("2000-01-31", periods=30, freq="ME")
+    source = pd.DataFrame(
+        {
+            "mthcaldt": np.repeat(dates.strftime("%Y-%m-%d"), 2),
+            "permno": np.tile([10001, 10002], 30),
+            "mthret": np.arange(60) / 100,
+        }
+    )
+    db_path = tmp_path / "crsp.sqlite"
+    with sqlite3.connect(db_path) as con:
+        source.iloc[:48].to_sql("msf", con, index=False)
+
+    queries = []
+
+    def make_query(start_date, end_date):
+        queries.append((start_date, end_date))
+        return f"""
+            SELECT * FROM msf
+            WHERE mthcaldt BETWEEN '{start_date}' AND '{end_date}'
+            """
+
+    def connect():
+        return sqlite3.connect(db_path)
+
+    kwargs = dict(date_cols=["mthcaldt"], key_cols=["permno", "mthcaldt"])
+    path = tmp_path / "crsp.parquet"
+    summary = refresh_partitioned_parquet(
+        make_query,
+        connect,
+        path,
+        "mthcaldt",
+        lookback=pd.DateOffset(months=3),
+        start_date="2000-01-01",
+        end_date="2001-12-31",
+        **kwargs,
+    )
+    assert summary["high_water_mark"] is None
+    assert summary["rows"] == 48
+    untouched = (path / "year=2000" / "part-0.parquet").stat().st_mtime_ns
+
+    # A restated return within the lookback window, and six new months
+    with sqlite3.connect(db_path) as con:
+        con.execute(
+            "UPDATE msf SET mthret = -0.5 WHERE mthcaldt = '2001-11-30'"
+            " AND permno = 10002"
+        )
+        source.iloc[48:].to_sql("msf", con, index=False, if_exists="append")
+    source.loc[
+        (source["mthcaldt"] == "2001-11-30") & (source["permno"] == 10002), "mthret"
+    ] = -0.5
+
+    summary = refresh_partitioned_parquet(
+        make_query,
+        connect,
+        path,
+        "mthcaldt",
+        lookback=pd.DateOffset(months=3),
+        end_date="2002-12-31",
+        **kwargs,
+    )
+    assert summary["high_water_mark"] == pd.Timestamp("2001-12-31")
+    assert queries[-1] == ("2001-09-30", "2002-12-31")
+    assert summary["rows"] == 2 * (4 + 6)
+    assert (path / "year=2000" / "part-0.parquet").stat().st_mtime_ns == untouched
+
+    result = load_parquet(path).sort_values(["mthcaldt", "permno"], ignore_index=True)
+    expected = source.assign(mthcaldt=pd.to_datetime(source["mthcaldt"]))
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_refresh_partitioned_parquet_updates_sharded_pull(tmp_path):
+    # The write-once-then-refresh path of pull_CRSP_Compustat with REFRESH_WRDS
+    dates = pd.date_range("2000-01-31", periods=36, freq="ME")
+    source = pd.DataFrame(
+        {
+            "gvkey": np.tile(["001000", "001001"], 36),
+            "datadate": np.repeat(dates.strftime("%Y-%m-%d"), 2),
+            "at": np.arange(72) * 1.0,
+        }
+    )
+    db_path = tmp_path / "comp.sqlite"
+    with sqlite3.connect(db_path) as con:
+        source.iloc[:48].to_sql("funda", con, index=False)
+
+    def make_query(start_date, end_date):
+        if start_date.startswith("2000") and fail_2000:
+            return "SELECT * FROM no_such_table"
+        return f"""
+            SELECT * FROM funda
+            WHERE datadate BETWEEN '{start_date}' AND '{end_date}'
+            """
+
+    def connect():
+        return sqlite3.connect(db_path, check_same_thread=False)
+
+    kwargs = dict(
+        date_cols=["datadate"],
+        column_types={"at": pa.float64()},
+        transform=lambda chunk: chunk.assign(year=chunk["datadate"].dt.year),
+    )
+    path = tmp_path / "comp.parquet"
+    assert not sharded_pull_complete(path, "2000-01-01")
+
+    fail_2000 = True
+    with pytest.raises(RuntimeError, match="year=2000"):
+        pull_sharded_to_parquet(
+            make_query, connect, path, "2000-01-01", "2001-12-31", retries=0, **kwargs
+        )
+    assert not sharded_pull_complete(path, "2000-01-01")
+
+    fail_2000 = False
+    pull_sharded_to_parquet(
+        make_query, connect, path, "2000-01-01", "2001-12-31", **kwargs
+    )
+    assert sharded_pull_complete(path, "2000-01-01")
+
+    # A restatement within the lookback window, and a new year of filings
+    with sqlite3.connect(db_path) as con:
+        con.execute(
+            "UPDATE funda SET at = -1.0 WHERE datadate = '2001-12-31'"
+            " AND gvkey = '001001'"
+        )
+        source.iloc[48:].to_sql("funda", con, index=False, if_exists="append")
+    source.loc[
+        (source["datadate"] == "2001-12-31") & (source["gvkey"] == "001001"), "at"
+    ] = -1.0
+
+    summary = refresh_partitioned_parquet(
+        make_query,
+        connect,
+        path,
+        "datadate",
+        key_cols=["gvkey", "datadate"],
+        lookback=pd.DateOffset(years=1),
+        end_date="2002-12-31",
+        **kwargs,
+    )
+    assert summary["high_water_mark"] == pd.Timestamp("2001-12-31")
+    assert summary["rows"] == 2 * (13 + 12)
+    assert sharded_pull_complete(path, "2000-01-01")
+
+    result = load_parquet(path).sort_values(["datadate", "gvkey"], ignore_index=True)
+    expected = source.assign(datadate=pd.to_datetime(source["datadate"]))
+    expected["year"] = expected["datadate"].dt.year
+    pd.testing.assert_frame_equal(result, expected)
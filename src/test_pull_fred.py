@@ -1,3 +1,9 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
 import pandas as pd
 import pytest
 from settings import config
@@ -5,6 +11,61 @@ import pull_fred
 DATA_DIR = config("DATA_DIR")
 
 
+class _FakeFredHandler(BaseHTTPRequestHandler):
+    """Serve fredgraph.csv-style responses for a few synthetic series."""
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        series_id = query["id"][0]
+        self.server.requests.append((series_id, query["cosd"][0], query["coed"][0]))
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(
+                self.server.max_in_flight, self.server.in_flight
+            )
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.in_flight -= 1
+        series = self.server.series[series_id]
+        series = series.loc[query["cosd"][0] : query["coed"][0]]
+        lines = [f"observation_date,{series_id}"]
+        lines += [
+            f"{date:%Y-%m-%d},{'.' if np.isnan(value) else value}"
+            for date, value in series.items()
+        ]
+        body = ("\n".join(lines) + "\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_fred():
+    """Local stand-in for the FRED CSV endpoint."""
+    dates = pd.date_range("2020-01-01", "2020-12-31", freq="D")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeFredHandler)
+    server.requests = []
+    server.latency = 0
+    server.lock = threading.Lock()
+    server.in_flight = server.max_in_flight = 0
+    server.series = {
+        "DAILY": pd.Series(np.arange(len(dates), dtype=float), index=dates),
+        "WEEKLY": pd.Series(np.arange(len(dates), dtype=float), index=dates)[::7],
+    }
+    server.series["DAILY"].iloc[5] = np.nan
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/fredgraph.csv"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 def test_pull_fred_functionality():
     df = pull_fred.pull_fred()
     # Test if the function returns a pandas DataFrame
@@ -28,3 +89,64 @@ def test_pull_fred_data_validity():
     # Test if the average annualized growth rate is close to 3.08%
     ave_annualized_growth = 4 * 100 * df.loc['1913-01-01': '2023-09-01', 'GDPC1'].dropna().pct_change().mean()
     assert abs(ave_annualized_growth - 3.08) < 0.1
+
+
+def test_pull_fred_cached_fetches_only_missing_tail(fake_fred, tmp_path):
+    series = ["DAILY", "WEEKLY"]
+    kwargs = dict(cache_dir=tmp_path, base_url=fake_fred.base_url)
+
+    df = pull_fred.pull_fred_cached(series, "2020-01-01", "2020-06-30", **kwargs)
+    assert df.index.min() == pd.Timestamp("2020-01-01")
+    assert df.index.max() == pd.Timestamp("2020-06-30")
+    assert df["DAILY"].isna().sum() == 1
+    assert df["WEEKLY"].count() == fake_fred.series["WEEKLY"][:"2020-06-30"].size
+    assert len(fake_fred.requests) == 2
+
+    # Recently fetched through the same end date, so nothing is requested
+    pull_fred.pull_fred_cached(series, "2020-01-01", "2020-06-30", **kwargs)
+    assert len(fake_fred.requests) == 2
+
+    # A later end date requests only the tail from the last cached observation
+    df = pull_fred.pull_fred_cached(series, "2020-01-01", "2020-12-31", **kwargs)
+    assert sorted(fake_fred.requests[2:]) == [
+        ("DAILY", "2020-06-30", "2020-12-31"),
+        ("WEEKLY", "2020-06-24", "2020-12-31"),
+    ]
+    expected = pd.concat(fake_fred.series, axis=1)
+    expected.index.name = "DATE"
+    pd.testing.assert_frame_equal(df, expected, check_freq=False)
+
+    # Once stale, the tail is requested again, unless the observations
+    # already reach the end date
+    pull_fred.pull_fred_cached(
+        series, "2020-01-01", "2020-12-31", max_age=pd.Timedelta(0), **kwargs
+    )
+    assert fake_fred.requests[4:] == [("WEEKLY", "2020-12-30", "2020-12-31")]
+
+    manifest = pull_fred._load_manifest(tmp_path)
+    assert manifest["WEEKLY"]["last_observation"] == "2020-12-30"
+
+    # An earlier start date than the cache holds triggers a full download
+    pull_fred.pull_fred_cached(["DAILY"], "2019-01-01", "2020-12-31", **kwargs)
+    assert fake_fred.requests[-1] == ("DAILY", "2019-01-01", "2020-12-31")
+
+
+def test_pull_fred_series_downloads_concurrently(fake_fred):
+    fake_fred.latency = 0.2
+    for i in range(8):
+        fake_fred.series[f"S{i}"] = fake_fred.series["WEEKLY"] * i
+    series = [f"S{i}" for i in range(8)] + ["DAILY"]
+
+    start = time.perf_counter()
+    df = pull_fred.pull_fred_series(
+        series, "2020-01-01", "2020-12-31", base_url=fake_fred.base_url
+    )
+    elapsed = time.perf_counter() - start
+
+    assert df.columns.tolist() == series
+    assert df.index.is_monotonic_increasing
+    assert df["DAILY"].isna().sum() == 1
+    assert (df["S3"].dropna() == 3 * fake_fred.series["WEEKLY"].values).all()
+    assert fake_fred.max_in_flight == 8
+    # Serially this would take 9 * 0.2 seconds
+    assert elapsed < 9 * fake_fred.latency / 2
@@ -0,0 +1,76 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import pytest
+
+import pull_ofr_api_data
+
+
+def _observations(mnemonic):
+    dates = pd.date_range("2023-01-02", periods=5, freq="B")
+    offset = len(mnemonic)
+    return [[f"{d:%Y-%m-%d}", offset + i] for i, d in enumerate(dates)]
+
+
+class _FakeOFRHandler(BaseHTTPRequestHandler):
+    """Serve the single- and multi-series OFR endpoints for any mnemonic."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append(url.path)
+        # Fail the first request once to exercise the retries
+        if len(self.server.requests) == 1:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if url.path.endswith("/series/timeseries"):
+            payload = _observations(query["mnemonic"][0])
+        else:
+            payload = {
+                m: {"timeseries": {"aggregation": _observations(m)}}
+                for m in query["mnemonics"][0].split(",")
+            }
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_ofr():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeOFRHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("batch_size", [1, 5, 12])
+def test_pull_series_list_concurrent(fake_ofr, batch_size):
+    series_list = list(pull_ofr_api_data.series_descriptions.keys())
+    df = pull_ofr_api_data.pull_series_list(
+        series_list,
+        batch_size=batch_size,
+        base_url=fake_ofr.base_url,
+    )
+    assert df.columns.tolist() == series_list
+    assert df.index.name == "Date"
+    assert len(df) == 5
+    assert df.loc["2023-01-03", "FNYR-BGCR-A"] == len("FNYR-BGCR-A") + 1
+
+    n_batches = -(-len(series_list) // batch_size)
+    # One extra request for the retried 503
+    assert len(fake_ofr.requests) == n_batches + 1
@@ -0,0 +1,33 @@
+"""
+Connection handling and settings shared by the modules that pull from WRDS.
+"""
+
+import wrds
+
+from misc_tools import borrow_connection
+from settings import config
+
+WRDS_USERNAME = config("WRDS_USERNAME")
+# Write the CRSP stock files as datasets partitioned by year (and
+# optionally exchange) instead of single files
+PARTITION_CRSP = config("PARTITION_CRSP", default=False, cast=bool)
+PARTITION_CRSP_BY_EXCHANGE = config(
+    "PARTITION_CRSP_BY_EXCHANGE", default=False, cast=bool
+)
+# Pull Compustat and the CRSP stock file into year-partitioned stores once,
+# and then refresh them incrementally on later runs
+REFRESH_WRDS = config("REFRESH_WRDS", default=False, cast=bool)
+
+
+def connect_to_wrds(wrds_username=WRDS_USERNAME):
+    """Return a function that opens a WRDS connection, for use with
+    `misc_tools.ConnectionPool`.
+    """
+    return lambda: wrds.Connection(wrds_username=wrds_username)
+
+
+def wrds_connection(wrds_username=WRDS_USERNAME, pool=None):
+    """Borrow a WRDS connection from `pool`, or open a new one that is
+    closed at the end of the `with` block. See `misc_tools.ConnectionPool`.
+    """
+    return borrow_connection(connect_to_wrds(wrds_username), pool)